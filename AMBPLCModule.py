@@ -0,0 +1,455 @@
+"""Gestión de controladores Modbus TCP desde un único bucle asyncio.
+
+Permite escanear cientos de controladores sin una hebra por cada uno:
+todos los AMBPLC de un MBScheduler se leen de forma concurrente
+desde el mismo bucle de eventos.
+
+"""
+
+__author__="José A. Casares"
+__date__="2026-10-18"
+__version__="1.0"
+
+from threading import Thread, current_thread
+from MBPLCModule import *
+import asyncio
+import time
+import struct
+
+
+class AsyncModbusClient(object):
+    """Cliente Modbus TCP asíncrono.
+
+    Implementa las funciones de lectura y escritura que usa MBPLC.
+    Las peticiones de un mismo cliente se envían de una en una.
+
+    Args:
+    address (str): Dirección IP (o nombre) del controlador.
+    port (int): Puerto de conexión.
+    timeout (float): Segundos de espera de una respuesta.
+
+    Attributes:
+    reader (StreamReader): Flujo de lectura de la conexión.
+    writer (StreamWriter): Flujo de escritura de la conexión.
+    transaction (int): Identificador de la última transacción.
+    lock (asyncio.Lock): Exclusión de peticiones simultáneas.
+
+    """
+
+    class Response(object):
+        """Respuesta de lectura, con los mismos atributos que las de pymodbus.
+
+        Args:
+        bits (bool[]): Bits leídos.
+        registers (int[]): Registros leídos.
+
+        """
+
+        def __init__(self, bits:list=None, registers:list=None):
+            self.bits=bits
+            self.registers=registers
+
+    def __init__(self, address:str, port:int=502, timeout:float=3.0):
+        self.address=address
+        self.port=port
+        self.timeout=timeout
+        self.reader=None
+        self.writer=None
+        self.transaction=0
+        self.lock=None
+
+    async def connect(self) -> bool:
+        ''' Abre la conexión.
+
+        Returns (bool):
+        Verdadero si se ha conectado.
+
+        '''
+        self.close()
+        self.lock=asyncio.Lock()
+        self.reader, self.writer=await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port), self.timeout)
+        return True
+
+    def close(self):
+        ''' Cierra la conexión.
+
+        '''
+        if not self.writer is None:
+            self.writer.close()
+        self.reader=None
+        self.writer=None
+
+    async def execute(self, unit:int, function:int, data:bytes) -> bytes:
+        ''' Envía una petición y espera su respuesta.
+
+        Args:
+        unit (int): Número de esclavo.
+        function (int): Código de función.
+        data (bytes): Datos de la petición.
+
+        Returns (bytes):
+        Datos de la respuesta, sin cabecera ni código de función.
+
+        '''
+        if self.writer is None:
+            raise Exception("Not connected to "+self.address+":"+str(self.port))
+        async with self.lock:
+            self.transaction=(self.transaction+1)&0xFFFF
+            self.writer.write(struct.pack(">HHHBB",self.transaction,0,len(data)+2,unit,function)+data)
+            await self.writer.drain()
+            while True:
+                header=await asyncio.wait_for(self.reader.readexactly(7),self.timeout)
+                transaction,protocol,length,unit=struct.unpack(">HHHB",header)
+                pdu=await asyncio.wait_for(self.reader.readexactly(length-1),self.timeout)
+                if transaction==self.transaction:
+                    break
+        if pdu[0]==function|0x80:
+            raise Exception("Modbus exception "+str(pdu[1])+" in function "+str(function))
+        return pdu[1:]
+
+    async def read_bits(self, function:int, address:int, count:int, unit:int) -> Response:
+        ''' Lectura de bits (funciones 1 y 2). '''
+        data=await self.execute(unit,function,struct.pack(">HH",address,count))
+        bits=[]
+        for byte in data[1:]:
+            bits.extend([bool(byte>>i & 1) for i in range(8)])
+        return AsyncModbusClient.Response(bits=bits[:count])
+
+    async def read_registers(self, function:int, address:int, count:int, unit:int) -> Response:
+        ''' Lectura de registros (funciones 3 y 4). '''
+        data=await self.execute(unit,function,struct.pack(">HH",address,count))
+        return AsyncModbusClient.Response(registers=list(struct.unpack(">"+str(count)+"H",data[1:1+2*count])))
+
+    async def read_coils(self, address:int, count:int, unit:int=1) -> Response:
+        ''' Lectura de bobinas. '''
+        return await self.read_bits(1,address,count,unit)
+
+    async def read_discrete_inputs(self, address:int, count:int, unit:int=1) -> Response:
+        ''' Lectura de entradas digitales. '''
+        return await self.read_bits(2,address,count,unit)
+
+    async def read_holding_registers(self, address:int, count:int, unit:int=1) -> Response:
+        ''' Lectura de registros de retención. '''
+        return await self.read_registers(3,address,count,unit)
+
+    async def read_input_registers(self, address:int, count:int, unit:int=1) -> Response:
+        ''' Lectura de registros de entrada. '''
+        return await self.read_registers(4,address,count,unit)
+
+    async def write_coil(self, address:int, value:bool, unit:int=1):
+        ''' Escritura de una bobina. '''
+        await self.execute(unit,5,struct.pack(">HH",address,0xFF00 if value else 0))
+
+    async def write_register(self, address:int, value:int, unit:int=1):
+        ''' Escritura de un registro. '''
+        await self.execute(unit,6,struct.pack(">HH",address,value&0xFFFF))
+
+    async def write_coils(self, address:int, values:list, unit:int=1):
+        ''' Escritura de bobinas consecutivas. '''
+        packed=bytearray((len(values)+7)//8)
+        for i,value in enumerate(values):
+            if value:
+                packed[i//8]|=1<<(i%8)
+        await self.execute(unit,15,struct.pack(">HHB",address,len(values),len(packed))+bytes(packed))
+
+    async def write_registers(self, address:int, values:list, unit:int=1):
+        ''' Escritura de registros consecutivos. '''
+        await self.execute(unit,16,struct.pack(">HHB",address,len(values),2*len(values))
+            +struct.pack(">"+str(len(values))+"H",*[value&0xFFFF for value in values]))
+
+
+class MBScheduler(object):
+    """Bucle de escaneo compartido por varios AMBPLC.
+
+    El bucle se ejecuta en su propia hebra, que se inicia al conectar
+    el primer controlador.
+
+    Attributes:
+    loop: Bucle de eventos.
+    thread (Thread): Hebra del bucle.
+    plc (AMBPLC[]): Controladores escaneados.
+    default (MBScheduler): Planificador usado cuando no se indica otro.
+
+    """
+
+    default=None
+
+    def __init__(self):
+        self.loop=asyncio.new_event_loop()
+        self.thread=Thread(target=self.loop.run_forever, args=(), daemon=True)
+        self.plc=[]
+
+    def add(self, plc:PLC):
+        ''' Inicia el escaneo de un controlador.
+
+        Args:
+        plc (AMBPLC): Controlador.
+
+        '''
+        if not self.thread.is_alive():
+            self.thread.start()
+        self.plc.append(plc)
+        self.start(plc)
+
+    def start(self, plc:PLC):
+        ''' Lanza en el bucle la corrutina de escaneo de un controlador.
+
+        Si la corrutina termina por un error, se registra y se vuelve a lanzar
+        tras la espera inicial de la política de reintentos del controlador.
+
+        Args:
+        plc (AMBPLC): Controlador.
+
+        '''
+        future=asyncio.run_coroutine_threadsafe(plc.poll(), self.loop)
+        future.add_done_callback(lambda future: self.restart(plc, future))
+
+    def restart(self, plc:PLC, future):
+        ''' Comprueba cómo ha terminado el escaneo de un controlador y lo relanza si ha fallado.
+
+        Args:
+        plc (AMBPLC): Controlador.
+        future (Future): Resultado de la corrutina de escaneo.
+
+        '''
+        if future.cancelled():
+            return
+        try:
+            future.result()
+        except Exception as e:
+            printexception(e,"Error polling AMBPLC "+plc.address+":"+str(plc.port)+"("+str(plc.unit)+"), restarting")
+            self.loop.call_soon_threadsafe(self.loop.call_later, plc.backoff.initial, self.start, plc)
+
+    def run(self, coroutine, timeout:float=None):
+        ''' Ejecuta una corrutina en el bucle desde otra hebra y espera su resultado.
+
+        No puede llamarse desde la hebra del bucle, que quedaría esperando
+        una corrutina que sólo ella puede ejecutar: ahí hay que usar await.
+
+        Args:
+        coroutine: Corrutina.
+        timeout (float): Segundos máximos de espera.
+
+        Returns:
+        Resultado de la corrutina.
+
+        '''
+        if current_thread() is self.thread:
+            coroutine.close()
+            raise Exception("Synchronous Modbus call from the scheduler loop: await the asynchronous client instead")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+
+class AMBPLC(MBPLC):
+    """PLC con comunicación Modbus TCP escaneado desde un bucle asyncio.
+
+    Mantiene las memorias y variables de MBPLC, de modo que puede usarse
+    igual desde Ensemble.import_tags.
+
+    Args:
+    address (str): Dirección IP (o nombre) del controlador.
+    port (int): Puerto de conexión. Típicamente el 502.
+    unit (int): Número de esclavo.
+    pollingtime (float): Segundos entre escaneos.
+    maxgap (int): Máximo número de direcciones sin variable que se leen
+        para no partir una petición en dos.
+    timeout (float): Segundos de espera de una respuesta.
+    scheduler (MBScheduler): Planificador (por defecto, uno compartido).
+
+    Attributes:
+    asyncclient (AsyncModbusClient): Cliente Modbus asíncrono.
+    client (Client): Fachada síncrona del cliente, para escrituras desde otras hebras.
+    asyncwakeup (asyncio.Event): Despierta al escaneo cuando hay escrituras pendientes.
+
+    """
+
+    class Client(object):
+        """Fachada síncrona de un AsyncModbusClient.
+
+        Ejecuta cada llamada en el bucle del planificador y espera su resultado,
+        por lo que no puede usarse desde la hebra del bucle (ver MBScheduler.run).
+
+        Args:
+        plc (AMBPLC): Controlador.
+
+        """
+
+        def __init__(self, plc:PLC):
+            self.plc=plc
+
+        def __getattr__(self, name:str):
+            function=getattr(self.plc.asyncclient, name)
+            return lambda *args, **kwargs: self.plc.scheduler.run(function(*args, **kwargs), self.plc.timeout)
+
+        def connect(self) -> bool:
+            return self.plc.scheduler.run(self.plc.asyncclient.connect(), self.plc.timeout)
+
+        def close(self):
+            self.plc.scheduler.loop.call_soon_threadsafe(self.plc.asyncclient.close)
+
+    def __init__(self, address:str, port:int=502, unit:int=1, pollingtime:float=1.0, maxgap:int=16,
+                 timeout:float=3.0, scheduler:MBScheduler=None):
+        super().__init__(address, port, unit, "tcp", 0, pollingtime, maxgap)
+        if scheduler is None:
+            if MBScheduler.default is None:
+                MBScheduler.default=MBScheduler()
+            scheduler=MBScheduler.default
+        self.scheduler=scheduler
+        self.timeout=timeout
+        self.asyncclient=AsyncModbusClient(address, port, timeout)
+        self.client=AMBPLC.Client(self)
+        self.thread=None
+        self.asyncwakeup=asyncio.Event()
+
+    def connect(self):
+        ''' Conexión con el controlador: se añade al planificador.
+
+        '''
+        self.scheduler.add(self)
+
+    async def read_async(self, now:float=None):
+        ''' Lectura asíncrona de las áreas de memoria del controlador.
+
+        Igual que MBPLC.read, pero sin bloquear el bucle mientras se espera a la red.
+
+        Args:
+        now (float): Momento actual (time.monotonic). Si se indica, sólo se leen
+            los bloques cuya próxima lectura ha vencido.
+
+        '''
+        self.begin()
+        try:
+            for memory,block in self.due(now):
+                rr = await getattr(self.asyncclient,memory.function)(block.start,block.count,unit=self.unit)
+                memory.dispatch(block,getattr(rr,memory.field))
+                block.readtime=memory.readtime=time.monotonic()
+                self.responded()
+        except Exception as e:
+            self.connected=False
+            self.asyncclient.close()
+            self.failed()
+            printexception(e,"Error reading from PLC")
+        finally:
+            self.commit()
+            with self.scanned:
+                self.scanned.notify_all()
+
+    def scanning(self) -> bool:
+        ''' Indica si la hebra actual es la del bucle del planificador.
+
+        Returns (bool):
+        Verdadero si es la hebra del bucle.
+
+        '''
+        return current_thread() is self.scheduler.thread
+
+    def fetch(self, memory:MBPLC.Memory, block:MBPLC.Memory.Block):
+        ''' Lee un bloque fuera de turno (ver MBPLC.fetch).
+
+        Desde la hebra del bucle no se puede esperar a la lectura sin bloquearlo:
+        sólo se adelanta, y la variable conserva de momento el valor en caché.
+
+        Args:
+        memory (Memory): Memoria del bloque.
+        block (Block): Bloque.
+
+        '''
+        if self.scanning():
+            block.due=0.0
+            self.asyncwakeup.set()
+        else:
+            super().fetch(memory, block)
+
+    def wake(self):
+        ''' Avisa al bucle de que hay escrituras pendientes.
+
+        '''
+        self.scheduler.loop.call_soon_threadsafe(self.asyncwakeup.set)
+
+    async def wait_async(self, seconds:float):
+        ''' Espera el tiempo indicado, o hasta que haya escrituras pendientes.
+
+        Args:
+        seconds (float): Segundos máximos de espera.
+
+        '''
+        try:
+            await asyncio.wait_for(self.asyncwakeup.wait(), seconds)
+            self.asyncwakeup.clear()
+        except asyncio.TimeoutError:
+            pass
+
+    async def write_async(self, values:dict) -> bool:
+        ''' Escritura asíncrona de varias variables (ver MBPLC.write).
+
+        Args:
+        values ({Tag:valor}): Valores por variable.
+
+        Returns (bool):
+        Verdadero si se han escrito todas las variables.
+
+        '''
+        if not self.connected:
+            return False
+        try:
+            requests=self.runs(values)
+        except Exception as e:
+            printexception(e,"Error writing to PLC")
+            return False
+        self.begin()
+        try:
+            for function,start,run,converted,raw in requests:
+                await getattr(self.asyncclient,function)(start,raw,unit=self.unit)
+                for tag,value in zip(run,converted):
+                    tag.update(value)
+                    tag.memory.invalidate(tag)
+            return True
+        except Exception as e:
+            self.connected=False
+            self.asyncclient.close()
+            printexception(e,"Error writing to PLC")
+            return False
+        finally:
+            self.commit()
+
+    async def flush_async(self) -> bool:
+        ''' Ejecuta las escrituras pendientes sin bloquear el bucle (ver PLC.flush).
+
+        Returns (bool):
+        Verdadero si no había escrituras o si se han realizado todas.
+
+        '''
+        writes, callbacks=self.pending()
+        result=True
+        if len(writes)>0:
+            result=await self.write_async(writes)
+        self.written(callbacks, result)
+        return result
+
+    async def poll(self):
+        ''' Escaneo periódico del controlador.
+
+        Cada bloque tiene su propio plazo de lectura (ver MBPLC.due), de modo que
+        un controlador lento no retrasa a los demás. Los reintentos de conexión
+        esperan en el bucle según la política de reintentos (ver PLC.backoff).
+        Las escrituras encoladas (ver PLC.queue) se ejecutan entre escaneos.
+
+        '''
+        while True:
+            await self.flush_async()
+            if self.connected:
+                await self.read_async(time.monotonic())
+                self.endscan()
+                await self.wait_async(max(self.nextscan()-time.monotonic(),0.0))
+            elif self.waittime()>0.0:
+                await self.wait_async(self.waittime())
+            else:
+                print("Connecting to AMBPLC "+self.address+":"+str(self.port)+"("+str(self.unit)+")")
+                self.state=PLC.CONNECTING
+                try:
+                    await self.asyncclient.connect()
+                    self.succeeded()
+                except Exception as e:
+                    printexception(e,"Error connecting to PLC")
+                    self.failed()
@@ -0,0 +1,698 @@
+''' Pruebas de rendimiento del SCADA.
+
+Se ejecuta como programa: python BenchmarkModule.py [modbus|opc|reconnect|bus|incremental]
+
+Las pruebas de escaneo no necesitan equipos reales: arrancan simuladores
+locales (servidor Modbus TCP y servidor OPC UA) con miles de valores que cambian.
+
+'''
+
+__author__="José A. Casares"
+__date__="2026-10-18"
+__version__="1.0"
+
+from UWServerModule import *
+from pymodbus3.server.sync import ModbusTcpServer
+from pymodbus3.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from autobahn.asyncio.websocket import WebSocketClientProtocol, WebSocketClientFactory
+from opcua import Server
+import os
+import re
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+
+def legacy_evaluation(serialization:list, tags:dict):
+    ''' Evaluación de una expresión tal y como se hacía antes de compilarlas.
+
+    Construye una cadena sustituyendo cada variable por su valor y la evalúa con eval.
+    Se conserva sólo como referencia para las comparaciones.
+
+    Args:
+    serialization (str[]): Expresión serializada.
+    tags (Tag{}): Diccionario de variables.
+
+    Returns:
+    Valor de la expresión.
+
+    '''
+    evaluation=""
+    for element in serialization:
+        if len(element)>0 and element[0].isalpha():
+            value=tags[element].get()
+            if value==None:
+                return None
+            else:
+                evaluation=evaluation+str(tags[element].get())
+        else:
+            evaluation=evaluation+element
+    return eval(evaluation)
+
+
+def benchmark_expression(definition:str="(nivel-offset)*2>90", repetitions:int=100000):
+    ''' Compara la evaluación de expresiones compiladas con la evaluación antigua.
+
+    Args:
+    definition (str): Definición de la expresión.
+    repetitions (int): Número de evaluaciones de cada método.
+
+    Returns ((float,float)):
+    Segundos empleados por el método antiguo y por el compilado.
+
+    '''
+    plc=PLC()
+    memory=plc.create("benchmark")
+    tags={}
+    for element in re.split("[ +\-*/()=<>]",definition):
+        if len(element)>0 and element[0].isalpha() and not element in tags:
+            tags[element]=memory.create(element,"",len(tags))
+            tags[element].update(len(tags)*10.0)
+    expression=Expression("benchmark",definition,tags)
+    expression.analyze()
+    serialization=re.split("( |\+|\-|\*|/|\(|\<|\>|\))",definition)
+
+    legacy=timeit.timeit(lambda: legacy_evaluation(serialization,tags), number=repetitions)
+    compiled=timeit.timeit(lambda: expression.update(None), number=repetitions)
+    print("Expression: "+definition)
+    print("Legacy:   {0:.3f} s ({1:.2f} us/evaluation)".format(legacy,legacy/repetitions*1e6))
+    print("Compiled: {0:.3f} s ({1:.2f} us/evaluation)".format(compiled,compiled/repetitions*1e6))
+    print("Speedup:  {0:.1f}x".format(legacy/compiled))
+    return legacy, compiled
+
+
+def benchmark_memory(count:int=200000, memory_factory=None):
+    ''' Mide la memoria ocupada por variable.
+
+    Crea count variables en una memoria y compara con variables
+    equivalentes que guardan sus atributos en un diccionario
+    y crean siempre su lista de suscriptores, como antes de usar __slots__.
+    La clase equivalente no deriva de Tag, para que ningún atributo quede
+    en __slots__, pero tiene los mismos atributos que la variable de la memoria.
+
+    Args:
+    count (int): Número de variables.
+    memory_factory: Función que devuelve la memoria donde se crean las variables
+        (por defecto, una memoria de PLC genérico).
+
+    Returns ((float,float)):
+    Bytes por variable con __dict__ y con __slots__.
+
+    '''
+    if memory_factory is None:
+        memory_factory=lambda: PLC().create("benchmark")
+    names=[name for tagclass in memory_factory().Tag.__mro__ for name in getattr(tagclass,"__slots__",())]
+
+    class DictTag(object):
+        def __init__(self, memory:PLC.Memory=None, key:str=None, description:str="", address=None):
+            for name in names:
+                setattr(self,name,None)
+            self.memory=memory
+            self.key=key
+            self.address=address
+            self.description=description
+            self.subscriptor=[]
+
+    results=[]
+    for tagclass in (DictTag, None):
+        memory=memory_factory()
+        if not tagclass is None:
+            memory.Tag=tagclass
+        tracemalloc.start()
+        before=tracemalloc.get_traced_memory()[0]
+        for i in range(count):
+            memory.create("tag"+str(i),"",i)
+        after=tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results.append((after-before)/count)
+    print("Tags: "+str(count)+" ("+type(memory).__module__+"."+type(memory).__qualname__+")")
+    print("With __dict__:  {0:.0f} bytes/tag".format(results[0]))
+    print("With __slots__: {0:.0f} bytes/tag".format(results[1]))
+    return results[0], results[1]
+
+
+class ModbusSimulator(object):
+    """Servidor Modbus TCP local que sustituye a un controlador real.
+
+    Los registros de retención 0 a count-1 cambian periódicamente;
+    el registro count es la sonda de latencia (ver stamp).
+
+    Args:
+    port (int): Puerto de escucha.
+    count (int): Número de registros que cambian.
+    period (float): Segundos entre cambios.
+    changes (float): Fracción de los registros que cambian en cada periodo.
+    units (int[]): Esclavos que responden, todos con la misma memoria, como detrás
+        de una pasarela; al resto se responde con una excepción. None para responder
+        a cualquier esclavo.
+
+    Attributes:
+    context (ModbusServerContext): Memoria del servidor.
+    server (ModbusTcpServer): Servidor.
+    running (bool): Los valores siguen cambiando.
+
+    """
+
+    def __init__(self, port:int=5020, count:int=2000, period:float=0.1, changes:float=0.1, units:list=None):
+        self.port=port
+        self.count=count
+        self.period=period
+        self.changes=changes
+        size=count+2
+        store=ModbusSlaveContext(di=ModbusSequentialDataBlock(0,[0]*size), co=ModbusSequentialDataBlock(0,[0]*size),
+                                 hr=ModbusSequentialDataBlock(0,[0]*size), ir=ModbusSequentialDataBlock(0,[0]*size))
+        self.store=store
+        if units is None:
+            self.context=ModbusServerContext(slaves=store, single=True)
+        else:
+            self.context=ModbusServerContext(slaves={unit:store for unit in units}, single=False)
+        self.server=ModbusTcpServer(self.context, address=("127.0.0.1",port))
+        self.running=False
+
+    def start(self):
+        ''' Arranca el servidor y los cambios de valores.
+
+        '''
+        self.running=True
+        Thread(target=self.server.serve_forever, args=(), daemon=True).start()
+        Thread(target=self.__Changing, args=(), daemon=True).start()
+
+    def stop(self):
+        ''' Detiene el servidor.
+
+        '''
+        self.running=False
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stamp(self, value:int):
+        ''' Escribe un valor en el registro de sonda.
+
+        Args:
+        value (int): Valor.
+
+        '''
+        self.store.set_values(3,self.count,[value & 0xFFFF])
+
+    def __Changing(self):
+        ''' Cambia una fracción de los registros en cada periodo.
+
+        '''
+        store=self.store
+        number=max(int(self.count*self.changes),1)
+        while self.running:
+            for address in random.sample(range(self.count),number):
+                store.set_values(3,address,[random.randint(0,100)])
+            time.sleep(self.period)
+
+
+class OPCSimulator(object):
+    """Servidor OPC UA local que sustituye a un controlador real.
+
+    Crea el objeto Simulation con las variables Tag0 a Tag{count-1},
+    que cambian periódicamente, y la variable Probe como sonda de latencia
+    (ver stamp).
+
+    Args:
+    port (int): Puerto de escucha.
+    count (int): Número de variables que cambian.
+    period (float): Segundos entre cambios.
+    changes (float): Fracción de las variables que cambian en cada periodo.
+
+    Attributes:
+    server (Server): Servidor.
+    namespace (int): Índice del espacio de nombres de las variables.
+    node (Node[]): Nodos de las variables.
+    probe (Node): Nodo de la sonda.
+    running (bool): Los valores siguen cambiando.
+
+    """
+
+    def __init__(self, port:int=4841, count:int=2000, period:float=0.1, changes:float=0.1):
+        self.port=port
+        self.count=count
+        self.period=period
+        self.changes=changes
+        self.server=Server()
+        self.server.set_endpoint("opc.tcp://127.0.0.1:"+str(port)+"/")
+        self.namespace=self.server.register_namespace("urn:uws:simulator")
+        simulation=self.server.get_objects_node().add_object(self.namespace,"Simulation")
+        self.node=[simulation.add_variable(self.namespace,"Tag"+str(i),0.0) for i in range(count)]
+        self.probe=simulation.add_variable(self.namespace,"Probe",0)
+        self.running=False
+
+    def address(self, name:str) -> str:
+        ''' Dirección de una variable del simulador, en el formato de OPCPLC.
+
+        Args:
+        name (str): Nombre de la variable.
+
+        Returns (str):
+        Ruta hasta el nodo.
+
+        '''
+        return str(self.namespace)+":Simulation\\"+str(self.namespace)+":"+name
+
+    def start(self):
+        ''' Arranca el servidor y los cambios de valores.
+
+        '''
+        self.server.start()
+        self.running=True
+        Thread(target=self.__Changing, args=(), daemon=True).start()
+
+    def stop(self):
+        ''' Detiene el servidor.
+
+        '''
+        self.running=False
+        self.server.stop()
+
+    def stamp(self, value:int):
+        ''' Escribe un valor en la sonda.
+
+        Args:
+        value (int): Valor.
+
+        '''
+        self.probe.set_value(value)
+
+    def __Changing(self):
+        ''' Cambia una fracción de las variables en cada periodo.
+
+        '''
+        number=max(int(self.count*self.changes),1)
+        while self.running:
+            for node in random.sample(self.node,number):
+                node.set_value(float(random.randint(0,100)))
+            time.sleep(self.period)
+
+
+class ScanCounter(Subscriptor):
+    """Cuenta los ciclos de escaneo y las actualizaciones de variables.
+
+    Attributes:
+    scans (int): Ciclos de escaneo terminados.
+    updates (int): Actualizaciones de variables recibidas.
+
+    """
+
+    def __init__(self):
+        self.scans=0
+        self.updates=0
+
+    def update(self, tag:PLC.Memory.Tag):
+        self.updates+=1
+
+    def update_batch(self, tags:list):
+        self.updates+=len(tags)
+
+    def endscan(self, plc:PLC):
+        self.scans+=1
+
+
+class ScanRecorder(Subscriptor):
+    """Registra el valor de una variable al final de cada ciclo de escaneo.
+
+    Args:
+    tag (Tag): Variable.
+
+    Attributes:
+    values ([]): Valores registrados, en orden.
+
+    """
+
+    def __init__(self, tag:PLC.Memory.Tag):
+        self.tag=tag
+        self.values=[]
+
+    def endscan(self, plc:PLC):
+        self.values.append(self.tag.value)
+
+
+class LatencyClient(WebSocketClientProtocol):
+    """Cliente websocket que mide la latencia de la sonda.
+
+    Se suscribe a la variable probe y, al recibir cada valor, calcula el tiempo
+    transcurrido desde que el simulador lo escribió.
+
+    Attributes:
+    stamps (float{}): Momento (time.monotonic) en que se escribió cada valor de la sonda.
+    latency (float[]): Latencias medidas en segundos.
+
+    """
+
+    stamps={}
+    latency=[]
+
+    def onOpen(self):
+        self.sendMessage(json.dumps({"action":"subscribe","tags":["probe"]}).encode("utf8"), isBinary=False)
+
+    def onMessage(self, payload, isBinary):
+        now=time.monotonic()
+        message=json.loads(payload.decode("utf8"))
+        if message["action"]=="values":
+            for key,value in message["tags"]:
+                value=int(float(value))
+                if key=="probe" and value in self.stamps:
+                    self.latency.append(now-self.stamps.pop(value))
+
+
+def generate_csv(directory:str, plc_key:str, memory_key:str, addresses:list, probe:str, alarms:int) -> tuple:
+    ''' Genera los ficheros de variables y alarmas de una prueba.
+
+    Las variables se llaman tag0, tag1... y la sonda, probe.
+    Cada alarma compara una variable con un umbral.
+
+    Args:
+    directory (str): Directorio de los ficheros.
+    plc_key (str): Nombre del controlador.
+    memory_key (str): Memoria de las variables.
+    addresses (str[]): Dirección de cada variable.
+    probe (str): Dirección de la sonda.
+    alarms (int): Número de alarmas.
+
+    Returns ((str,str)):
+    Rutas de los ficheros de variables y de alarmas.
+
+    '''
+    tagsfile=os.path.join(directory,"vars.csv")
+    alarmsfile=os.path.join(directory,"alarms.csv")
+    with open(tagsfile,"w",newline="",encoding="utf8") as file:
+        stream=csv.writer(file,delimiter=";")
+        stream.writerow(["Name","PLC","Memory","Element","Description"])
+        for i,address in enumerate(addresses):
+            stream.writerow(["tag"+str(i),plc_key,memory_key,address,"Simulated "+str(i)])
+        stream.writerow(["probe",plc_key,memory_key,probe,"Latency probe"])
+    with open(alarmsfile,"w",newline="",encoding="utf8") as file:
+        stream=csv.writer(file,delimiter=";")
+        stream.writerow(["Name","Definition","Description"])
+        for i in range(alarms):
+            stream.writerow(["alarm"+str(i),"tag"+str(i%len(addresses))+">"+str(50+i%50),"{0.key} high"])
+    return tagsfile, alarmsfile
+
+
+def websocket_server(ensemble:Ensemble, port:int):
+    ''' Arranca en su propia hebra un servidor websocket del SCADA.
+
+    Args:
+    ensemble (Ensemble): Motor del SCADA.
+    port (int): Puerto del websocket.
+
+    Returns:
+    Bucle de eventos del servidor.
+
+    '''
+    loop=asyncio.new_event_loop()
+    factory=WebSocketServerFactory(u"ws://127.0.0.1:"+str(port), loop=loop)
+    factory.protocol=WSHandle
+    WSHandle.ensemble=ensemble
+    loop.run_until_complete(loop.create_server(factory,"127.0.0.1",port))
+    client=WebSocketClientFactory(u"ws://127.0.0.1:"+str(port), loop=loop)
+    client.protocol=LatencyClient
+    loop.run_until_complete(loop.create_connection(client,"127.0.0.1",port))
+    Thread(target=loop.run_forever, args=(), daemon=True).start()
+    return loop
+
+
+def benchmark_scan(driver:str="modbus", tags:int=2000, alarms:int=1000, duration:float=10.0,
+                   port:int=None, ws_port:int=8091, pollingtime:float=0.0, vectorized:bool=False) -> dict:
+    ''' Mide el rendimiento de escaneo frente a un simulador local.
+
+    Genera los ficheros de variables y alarmas, los carga con Ensemble.import_tags
+    e import_alarms, despliega el motor y, durante duration segundos, cuenta
+    ciclos de escaneo, actualizaciones de variables y evaluaciones de alarmas.
+    La latencia de extremo a extremo es el tiempo desde que el simulador cambia
+    la sonda hasta que el nuevo valor llega a un cliente websocket.
+
+    Args:
+    driver (str): Simulador y controlador: modbus (MBPLC) u opc (OPCPLC).
+    tags (int): Número de variables.
+    alarms (int): Número de alarmas.
+    duration (float): Segundos de medida.
+    port (int): Puerto del simulador (por defecto, 5020 para Modbus y 4841 para OPC UA).
+    ws_port (int): Puerto del websocket.
+    pollingtime (float): Segundos entre escaneos del controlador Modbus (0 para escanear sin pausa).
+    vectorized (bool): Evaluación vectorizada de las alarmas sencillas.
+
+    Returns ({str:float}):
+    Tiempo hasta recibir el primer valor de la sonda, escaneos, actualizaciones y evaluaciones por segundo,
+    y latencias media y máxima en segundos.
+
+    '''
+    if driver=="modbus":
+        simulator=ModbusSimulator(port or 5020, tags)
+        plc=MBPLC("127.0.0.1", simulator.port, pollingtime=pollingtime, maxgap=16)
+        plc.thread.daemon=True
+        memory_key="holding"
+        addresses=[str(i) for i in range(tags)]
+        probe=str(tags)
+    elif driver=="opc":
+        simulator=OPCSimulator(port or 4841, tags)
+        plc=OPCPLC("127.0.0.1", simulator.port, interval=100)
+        plc.thread.daemon=True
+        memory_key=""
+        addresses=[simulator.address("Tag"+str(i)) for i in range(tags)]
+        probe=simulator.address("Probe")
+    else:
+        raise Exception("Unknown benchmark driver: "+driver)
+    simulator.start()
+    ensemble=Ensemble(vectorized)
+    ensemble["plc"]=plc
+    with tempfile.TemporaryDirectory() as directory:
+        tagsfile,alarmsfile=generate_csv(directory,"plc",memory_key,addresses,probe,alarms)
+        ensemble.import_tags(tagsfile)
+        ensemble.import_alarms(alarmsfile)
+    counter=ScanCounter()
+    plc.subscribe_scan(counter)
+    for key,tag in ensemble.tag.items():
+        if not isinstance(tag,Expression):
+            tag.subscribe(counter)
+    start=time.monotonic()
+    ensemble.deploy()
+    while (not plc.connected or ensemble.tag["probe"].value is None) and time.monotonic()-start<60.0:
+        time.sleep(0.01)
+    connecttime=time.monotonic()-start
+    websocket_server(ensemble, ws_port)
+    time.sleep(1.0)
+
+    def evaluations():
+        count=ensemble.graph.evaluations
+        if not ensemble.vectorengine is None:
+            count+=ensemble.vectorengine.evaluations
+        return count
+
+    LatencyClient.latency.clear()
+    scans,updates,evaluated=counter.scans,counter.updates,evaluations()
+    start=time.monotonic()
+    sequence=0
+    while time.monotonic()-start<duration:
+        sequence+=1
+        LatencyClient.stamps[sequence]=time.monotonic()
+        simulator.stamp(sequence)
+        time.sleep(0.1)
+    elapsed=time.monotonic()-start
+    results={"connect":connecttime,
+             "scans":(counter.scans-scans)/elapsed,
+             "updates":(counter.updates-updates)/elapsed,
+             "evaluations":(evaluations()-evaluated)/elapsed,
+             "latency":sum(LatencyClient.latency)/len(LatencyClient.latency) if len(LatencyClient.latency)>0 else None,
+             "maxlatency":max(LatencyClient.latency) if len(LatencyClient.latency)>0 else None}
+    plc.disconnect()
+    simulator.stop()
+    print("Scan benchmark: "+driver+", "+str(tags)+" tags, "+str(alarms)+" alarms"+(" (vectorized)" if vectorized else ""))
+    print("Connect:     {0:.2f} s".format(results["connect"]))
+    print("Scans:       {0:.1f} /s".format(results["scans"]))
+    print("Updates:     {0:.0f} /s".format(results["updates"]))
+    print("Evaluations: {0:.0f} /s".format(results["evaluations"]))
+    if not results["latency"] is None:
+        print("Latency:     {0:.1f} ms (max {1:.1f} ms)".format(results["latency"]*1e3,results["maxlatency"]*1e3))
+    if driver=="opc":
+        print("Notifications: "+str(plc.handler.notifications)+" (coalesced "+str(plc.handler.coalesced)+", overflows "+str(plc.handler.overflows)+")")
+    return results
+
+
+def benchmark_reconnect(tags:int=2000, port:int=4841, keepalive:float=1.0, timeout:float=120.0) -> tuple:
+    ''' Mide el tiempo que tarda OPCPLC en restablecer el flujo de datos tras reiniciar el servidor.
+
+    Se detiene el simulador OPC UA, se arranca uno nuevo con los mismos nodos
+    y se espera hasta que llega al controlador un nuevo valor de la sonda,
+    la última variable que se suscribe.
+
+    Args:
+    tags (int): Número de variables.
+    port (int): Puerto del simulador.
+    keepalive (float): Segundos entre comprobaciones de la conexión.
+    timeout (float): Segundos máximos de espera.
+
+    Returns ((float,float)):
+    Segundos desde la caída del servidor hasta que se detecta,
+    y desde que el servidor vuelve hasta que llegan datos.
+
+    '''
+    simulator=OPCSimulator(port,tags)
+    simulator.start()
+    plc=OPCPLC("127.0.0.1", port, interval=100, keepalive=keepalive)
+    plc.thread.daemon=True
+    memory=plc.get("")
+    for i in range(tags):
+        memory.create("tag"+str(i),"",simulator.address("Tag"+str(i)))
+    probe=memory.create("probe","",simulator.address("Probe"))
+    plc.connect()
+
+    def waitfor(condition):
+        start=time.monotonic()
+        while not condition() and time.monotonic()-start<timeout:
+            simulator.stamp(value)
+            time.sleep(0.01)
+        return time.monotonic()-start
+
+    value=1
+    waitfor(lambda: probe.value==value)
+    simulator.stop()
+    detection=waitfor(lambda: not plc.connected)
+    simulator=OPCSimulator(port,tags)
+    simulator.start()
+    value=2
+    restore=waitfor(lambda: probe.value==value)
+    plc.disconnect()
+    simulator.stop()
+    print("Reconnect benchmark: "+str(tags)+" tags, keepalive "+str(keepalive)+" s")
+    print("Detection: {0:.2f} s".format(detection))
+    print("Restore:   {0:.2f} s".format(restore))
+    return detection, restore
+
+
+def benchmark_bus(units:int=3, dead:int=1, tags:int=100, port:int=5021, pollingtime:float=0.1,
+                  duration:float=20.0, interframe:float=0.02) -> tuple:
+    ''' Comprueba el escaneo de una línea compartida (MBBus) con esclavos que no responden.
+
+    El simulador Modbus hace de pasarela: responde por los primeros esclavos y
+    devuelve una excepción por el resto. Los esclavos caídos deben apartarse
+    con esperas crecientes (ver PLC.backoff), aunque abrir la línea tenga éxito,
+    y los que responden deben seguir leyéndose a su ritmo.
+
+    La pasarela es Modbus TCP, porque el cliente RTU sobre TCP de pymodbus3 no
+    interpreta las respuestas, pero la línea aplica igualmente el silencio entre
+    tramas: se mide el hueco entre el fin de cada petición y el inicio de la siguiente.
+
+    Args:
+    units (int): Número de esclavos de la línea.
+    dead (int): Número de esclavos que no responden (los últimos).
+    tags (int): Variables de cada esclavo.
+    port (int): Puerto del simulador.
+    pollingtime (float): Segundos entre escaneos de cada esclavo.
+    duration (float): Segundos de medida.
+    interframe (float): Silencio entre tramas de la línea.
+
+    Returns ((float,float[],float)):
+    Escaneos por segundo de cada esclavo que responde, segundos entre
+    los intentos de conexión sucesivos con el primer esclavo caído
+    y menor hueco medido entre dos tramas.
+
+    '''
+    simulator=ModbusSimulator(port,tags,units=list(range(1,units-dead+1)))
+    simulator.start()
+    bus=MBBus("127.0.0.1:"+str(port), method="tcp", interframe=interframe)
+    frames=[]
+    execute=bus.modbus.execute
+
+    def timed(*args, **kwargs):
+        begin=time.monotonic()
+        try:
+            return execute(*args, **kwargs)
+        finally:
+            frames.append((begin,time.monotonic()))
+
+    bus.modbus.execute=timed
+    plcs=[]
+    counters=[]
+    for unit in range(1,units+1):
+        plc=MBPLC(unit=unit, pollingtime=pollingtime, bus=bus)
+        for i in range(tags):
+            plc.holding.create("tag"+str(i),"",i)
+        counter=ScanCounter()
+        plc.subscribe_scan(counter)
+        plcs.append(plc)
+        counters.append(counter)
+        plc.connect()
+    failed=plcs[units-dead]
+    attempts=[]
+    start=time.monotonic()
+    while time.monotonic()-start<duration:
+        if len(attempts)==0 or attempts[-1][0]!=failed.attempts:
+            attempts.append((failed.attempts,time.monotonic()))
+        time.sleep(0.01)
+    elapsed=time.monotonic()-start
+    bus.plc.clear()
+    simulator.stop()
+    scans=[counter.scans/elapsed for counter in counters[:units-dead]]
+    intervals=[attempts[i][1]-attempts[i-1][1] for i in range(2,len(attempts))]
+    gap=min(frames[i][0]-frames[i-1][1] for i in range(1,len(frames)))
+    print("Bus benchmark: "+str(units)+" units ("+str(dead)+" not responding), "+str(tags)+" tags each")
+    print("Scans:     "+", ".join("{0:.1f} /s".format(rate) for rate in scans))
+    print("Attempts:  "+str(failed.attempts))
+    print("Intervals: "+", ".join("{0:.1f} s".format(interval) for interval in intervals))
+    print("Frames:    "+str(len(frames))+", minimum gap {0:.1f} ms (interframe {1:.1f} ms): ".format(gap*1000,interframe*1000)
+          +("OK" if gap>=interframe else "FAILED"))
+    return sum(scans)/len(scans), intervals, gap
+
+
+def benchmark_incremental(rows:int=10000) -> tuple:
+    ''' Comprueba y mide la lectura incremental de DBPLC sobre SQLite en memoria.
+
+    La tabla se crea sin clave primaria, de modo que hay registros con la misma
+    fecha, y los registros se insertan en dos tandas que parten una de esas fechas.
+    Cada registro debe llegar una sola vez y cerrar su propio ciclo de escaneo
+    (ver DBPLC.read_incremental), que es lo que ven las alarmas vectorizadas.
+
+    Args:
+    rows (int): Número de registros.
+
+    Returns ((bool,float)):
+    Si se han recibido todos los registros una sola vez, y registros leídos por segundo.
+
+    '''
+    plc=DBPLC("sqlite://", incremental=True)
+    memory=plc.create("log")
+    tag=memory.create("value")
+    Table("log", MetaData(), Column("date",DateTime), Column("value",Float)).create(plc.engine)
+    plc.open()
+    plc.connected=True
+    recorder=ScanRecorder(tag)
+    plc.subscribe_scan(recorder)
+    base=datetime.datetime(2026,1,1)
+    plc.engine.execute(memory.table.insert(),[{"date":base,"value":0.0}])
+    plc.read_incremental()
+    records=[{"date":base+datetime.timedelta(seconds=(i+1)//2),"value":float(i)} for i in range(1,rows+1)]
+    split=rows//2|1     # El último registro de la primera tanda comparte fecha con el primero de la segunda.
+    start=time.monotonic()
+    for batch in (records[:split],records[split:]):
+        plc.engine.execute(memory.table.insert(),batch)
+        plc.read_incremental()
+    elapsed=time.monotonic()-start
+    plc.engine.execute(memory.table.insert(),[{"date":base+datetime.timedelta(seconds=rows),"value":-1.0}])
+    plc.read_incremental()
+    plc.read_incremental()
+    expected=[float(i) for i in range(rows+1)]+[-1.0]
+    ok=sorted(recorder.values[:-1])==expected[:-1] and recorder.values[-1]==-1.0 and len(recorder.values)==len(expected)
+    print("Incremental benchmark: "+str(rows)+" rows, SQLite in memory")
+    print("Scans:  "+str(len(recorder.values))+" (expected "+str(len(expected))+")")
+    print("Check:  "+("OK" if ok else "FAILED"))
+    print("Rows:   {0:.0f} /s".format(rows/elapsed))
+    return ok, rows/elapsed
+
+
+if __name__=="__main__":
+    if len(sys.argv)>1 and sys.argv[1]=="reconnect":
+        benchmark_reconnect()
+    elif len(sys.argv)>1 and sys.argv[1]=="bus":
+        benchmark_bus()
+    elif len(sys.argv)>1 and sys.argv[1]=="incremental":
+        benchmark_incremental()
+    elif len(sys.argv)>1:
+        benchmark_scan(sys.argv[1])
+    else:
+        benchmark_expression()
+        benchmark_memory()
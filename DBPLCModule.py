@@ -6,9 +6,10 @@ __author__="José A. Casares"
 __date__="2016-04-30"
 __version__="1.0"
 
-from threading import Thread
+from threading import Thread, Lock
 from TagModule import *
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import Counter
 from sqlalchemy import *
 import time
 
@@ -18,13 +19,32 @@ class DBPLC(PLC):
     Args:
     connection (str): Cadena de conexión.
     pollingtime (float): Segundos entre escaneos.
+    incremental (bool): Sólo se leen los registros posteriores al último leído de cada
+        tabla, y se procesan todos en orden, cada uno en su propia transacción
+        y con su propio final de ciclo de escaneo (ver PLC.endscan).
+    maxpollingtime (float): En modo incremental, máximo de segundos entre escaneos.
+        Mientras no llegan registros, la espera se duplica hasta este límite.
+    rollup (bool): Mantener tablas agregadas (ver rollups) junto a cada tabla, que
+        get_data usa para las tendencias de periodos largos.
+    rolluptime (float): Segundos entre actualizaciones de las tablas agregadas.
 
     Attributes:
     engine (Engine): Conector con base de datos.
     thread (Thread): Hebra de escaneo.
+    idletime (float): Espera actual entre escaneos en modo incremental.
+    rollupthread (Thread): Hebra de mantenimiento de las tablas agregadas.
+    rollups ((int,str)[]): Resolución en segundos y sufijo de nombre de las tablas agregadas,
+        de la más fina a la más gruesa.
+    rollupcolumns ((str,type)[]): Sufijo y tipo de las columnas de cada variable en las
+        tablas agregadas, en el orden de los intervalos de Tag.get_buckets.
+    rollupchunk (int): Máximo de intervalos que se agregan en cada consulta e inserción.
     
     """
 
+    rollups=((60,"1m"),(3600,"1h"),(86400,"1d"))
+    rollupcolumns=(("_min",Float),("_max",Float),("_avg",Float),("_count",Integer),("_mintime",Integer),("_maxtime",Integer))
+    rollupchunk=1440
+
 
     class Memory(PLC.Memory):
         ''' Representación de un área de memoria (tabla).
@@ -34,6 +54,16 @@ class DBPLC(PLC):
 
         Attributes:
         Table (Table): Tabla.
+        lastdate (datetime): Fecha del último registro leído en modo incremental (None si aún no se ha leído).
+        lastrows (Counter): Registros ya leídos con fecha lastdate, para no repetirlos si
+            llegan más con la misma fecha (en tablas cuya clave no es la fecha).
+        rollup (Table{}): Tablas agregadas por resolución (ver DBPLC.rollups). Cada registro
+            es un intervalo, identificado por su inicio (start, en segundos desde 1970
+            sin zona horaria), con columnas [variable]_min, _max, _avg, _count, _mintime
+            y _maxtime (ver DBPLC.rollupcolumns).
+        rolled (int{}): Por resolución, inicio del primer intervalo aún no agregado
+            (None si la tabla agregada está vacía).
+        rolling (Lock): Exclusión entre maintain y rewind.
 
         '''
 
@@ -49,106 +79,429 @@ class DBPLC(PLC):
             Attributes:
             value: Valor.
             subscriptor (Subcriptor[]): Objetos suscritos a los cambios.
+            column (Column): Columna de la tabla (se crea al conectar).
             
             '''
 
+            __slots__=("column",)
+
             def __init__(self, memory:PLC.Memory, key:str, description:str="", address=None):
+                self.column=None
                 super().__init__(memory,key,description)
                 
-            def set(self, value, date:datetime=None):
+            def set(self, value, date:datetime=None) -> bool:
                 ''' Modifica el valor de una variable. En este contexto inserta un dato en la tabla.
                 Importante: si la memoria contiene más de una variable, las demás columnas se quedan en nulo.
+                Si la fecha ya está agregada, se vuelven a calcular sus intervalos (ver Memory.rewind).
 
                 Args:
                 value: Nuevo valor de la variable.
                 datetime: Fecha y hora del valor (por defecto, la actual).
 
+                Returns (bool):
+                Verdadero si se ha insertado el dato.
+
                 '''
-                if date==None:
-                    date=func.now()
                 plc=self.memory.plc
-                if plc.connected:
-                    try:
-                        d=dict([("date",date),(self.key,value)])
-                        i=self.memory.table.insert().values(**d)
-                        i.compile().params
-                        plc.engine.execute(i)
-                        self.update(value)
-                    except Exception as e:
-                        self.memory.plc.connected=False
-                        printexception(e,"Error writing to PLC")
+                if not plc.connected:
+                    return False
+                try:
+                    d=dict([("date",func.now() if date is None else date),(self.key,value)])
+                    i=self.memory.table.insert().values(**d)
+                    i.compile().params
+                    plc.engine.execute(i)
+                    if not date is None:
+                        self.memory.rewind(date)
+                    self.update(value)
+                    return True
+                except Exception as e:
+                    self.memory.plc.connected=False
+                    printexception(e,"Error writing to PLC")
+                    return False
+
+            def refresh(self):
+                ''' Lee el registro más reciente de la tabla y actualiza sus variables.
+
+                Tag.get usa el valor en caché que mantiene el escaneo, y sólo llama
+                a este método según la política de frescura (ver PLC.maxage).
+                Con una sola consulta se refresca toda la tabla, de modo que
+                el resto de sus variables vuelven a leerse de la caché.
 
-            def get(self):
-                ''' Devuelve el valor de una variable. En este contexto, valor más reciente.
+                Returns:
+                Valor de la variable.
 
                 '''
                 plc=self.memory.plc
                 if plc.connected:
                     try:
-                        s = select([self.column]).order_by(desc(text("date"))).limit(1)
-                        self.value=plc.engine.execute(s).fetchone()[0]
-                        return self.value
+                        row=self.memory.latest()
+                        self.memory.readtime=time.monotonic()
+                        if not row is None:
+                            self.memory.dispatch(row)
                     except Exception as e:
                         printexception(e,"Error reading from PLC")
+                return self.value
 
-            def get_data(self, datefrom:datetime, dateto:datetime):
+            def get_data(self, datefrom:datetime, dateto:datetime, points:int=None):
                 ''' Devuelve los registros de esa variable entre dos momentos.
 
+                Si se indica points, los datos se agrupan en intervalos de igual duración
+                y de cada uno se devuelven el mínimo y el máximo (ver get_buckets y minmax),
+                de modo que no se devuelven más de unos points puntos. Los intervalos se
+                calculan de la tabla agregada más gruesa que lo permita (ver resolution).
+
                 Args:
-                datefrom (datetime): Fecha y hora de inicio.
-                dateto (datetime): Fecha y hora de fin.
+                datefrom (datetime): Fecha y hora de inicio (UNIX en milisegundos).
+                dateto (datetime): Fecha y hora de fin (UNIX en milisegundos).
+                points (int): Número aproximado de puntos (None para todos los registros).
 
                 Returns ([[time(UNIX),[float]]):
                 Lista con pares tiempo (formato UNIX) y valor.
             
                 '''
                 plc=self.memory.plc
-                _from=datetime.fromtimestamp(datefrom/1000).strftime('%Y-%m-%d %H:%M:%S')
-                _to=datetime.fromtimestamp(dateto/1000).strftime('%Y-%m-%d %H:%M:%S')
+                _from=datetime.fromtimestamp(datefrom//1000)
+                _to=datetime.fromtimestamp(dateto//1000)
+                date=self.memory.table.c.date
                 if plc.connected:
                     try:
-                        s = select([literal_column("date"),
-                            self.column]).where(literal_column("date")>_from).where(literal_column("date")<_to).order_by(asc(text("date")))               
-                        values=plc.engine.execute(s).fetchall()
-                        results=[]
-                        for value in values:
-                            results.append([int(time.mktime(value[0].timetuple()))*1000,value[1]])
-                        results2=[[datefrom,results[0][1]]]+results+[[dateto,results[-1][1]]] # Añade un primer y último elemento
-                        print(results2)
-                        return results2
+                        if points is None or points<2:
+                            s = select([date,self.column]).where(date>_from).where(date<_to).order_by(asc(date))
+                            values=plc.engine.execute(s).fetchall()
+                            results=[]
+                            for value in values:
+                                results.append([int(time.mktime(value[0].timetuple()))*1000,value[1]])
+                        else:
+                            width=max(int((dateto-datefrom)/1000/(points//2)),1)
+                            resolution=self.resolution(width)
+                            if not resolution is None:
+                                width=width+(-width)%resolution
+                                results=self.minmax(self.get_rollup(_from,_to,width,resolution))
+                            else:
+                                results=self.minmax(self.get_buckets(_from,_to,width))
+                        if len(results)==0:
+                            return results
+                        return [[datefrom,results[0][1]]]+results+[[dateto,results[-1][1]]] # Añade un primer y último elemento
                     except Exception as e:
                         printexception(e,"Error reading from PLC")
-                        
+
+            def get_buckets(self, datefrom:datetime, dateto:datetime, width:int) -> list:
+                ''' Agrega los registros de la variable en intervalos de igual duración.
+
+                La agregación se hace en la base de datos si se sabe extraer
+                los segundos de una fecha en su dialecto (ver DBPLC.epoch): una consulta
+                agrupa los registros, y otra busca en cada intervalo, entre su primera
+                y su última fecha, cuándo se alcanzan el mínimo y el máximo.
+                Si no, se leen los registros y se agregan aquí.
+                Los registros nulos no se cuentan.
+
+                Args:
+                datefrom (datetime): Fecha y hora de inicio.
+                dateto (datetime): Fecha y hora de fin.
+                width (int): Segundos de cada intervalo.
+
+                Returns ([(int,float,float,float,int,int,int)]):
+                Inicio del intervalo (segundos desde 1970, sin zona horaria), mínimo,
+                máximo, media, número de registros y momentos (en segundos) en que
+                se alcanzan por primera vez el mínimo y el máximo, en orden.
+
+                '''
+                plc=self.memory.plc
+                table=self.memory.table
+                date=table.c.date
+                epoch=plc.epoch(date)
+                if not epoch is None:
+                    seconds=cast(epoch,Integer)
+                    start=seconds-seconds%width
+                    buckets = select([start.label("start"),func.min(self.column).label("minimum"),func.max(self.column).label("maximum"),
+                                      func.avg(self.column).label("average"),func.count(self.column).label("count"),
+                                      func.min(date).label("first"),func.max(date).label("last")]).where(
+                        date>=datefrom).where(date<dateto).where(self.column!=None).group_by(start).alias("buckets")
+                    s = select([buckets.c.start,buckets.c.minimum,buckets.c.maximum,buckets.c.average,buckets.c.count,
+                                func.min(case([(self.column==buckets.c.minimum,seconds)])),
+                                func.min(case([(self.column==buckets.c.maximum,seconds)]))]).select_from(
+                        buckets.join(table,and_(date>=buckets.c.first,date<=buckets.c.last))).group_by(
+                        buckets.c.start,buckets.c.minimum,buckets.c.maximum,buckets.c.average,buckets.c.count).order_by(buckets.c.start)
+                    return [tuple(row) for row in plc.engine.execute(s).fetchall()]
+                s = select([date,self.column]).where(date>=datefrom).where(date<dateto).where(self.column!=None).order_by(asc(date))
+                buckets=[]
+                for row in plc.engine.execute(s):
+                    seconds=DBPLC.seconds(row[0])
+                    start=seconds-seconds%width
+                    if len(buckets)==0 or buckets[-1][0]!=start:
+                        buckets.append([start,row[1],row[1],0.0,0,seconds,seconds])
+                    bucket=buckets[-1]
+                    if row[1]<bucket[1]:
+                        bucket[1],bucket[5]=row[1],seconds
+                    if row[1]>bucket[2]:
+                        bucket[2],bucket[6]=row[1],seconds
+                    bucket[3]=(bucket[3]*bucket[4]+row[1])/(bucket[4]+1)
+                    bucket[4]+=1
+                return [tuple(bucket) for bucket in buckets]
+
+            def resolution(self, width:int) -> int:
+                ''' Elige la tabla agregada con la que calcular intervalos de una duración.
+
+                Args:
+                width (int): Segundos de cada intervalo.
+
+                Returns (int):
+                La resolución más gruesa que no supera width, entre las tablas agregadas
+                que tienen datos, o None si hay que usar la tabla de registros.
+
+                '''
+                resolution=None
+                for rollup,suffix in DBPLC.rollups:
+                    if rollup<=width and not self.memory.rolled.get(rollup) is None:
+                        resolution=rollup
+                return resolution
+
+            def get_rollup(self, datefrom:datetime, dateto:datetime, width:int, resolution:int) -> list:
+                ''' Agrega los datos de la variable en intervalos a partir de una tabla agregada.
+
+                La parte del periodo que aún no está agregada se completa con la tabla
+                de registros (ver get_buckets), y el intervalo que queda partido
+                entre ambas se combina.
+
+                Args:
+                datefrom (datetime): Fecha y hora de inicio.
+                dateto (datetime): Fecha y hora de fin.
+                width (int): Segundos de cada intervalo, múltiplo de resolution.
+                resolution (int): Resolución de la tabla agregada.
+
+                Returns ([(int,float,float,float,int,int,int)]):
+                Intervalos, como en get_buckets.
+
+                '''
+                memory=self.memory
+                start=DBPLC.seconds(datefrom)
+                end=DBPLC.seconds(dateto)
+                rolled=memory.rolled[resolution]
+                buckets=memory.reaggregate(memory.rollup[resolution],self.key,width,start-start%resolution,min(end,rolled))
+                if rolled<end:
+                    for bucket in self.get_buckets(DBPLC.date(max(rolled,start)),dateto,width):
+                        if len(buckets)>0 and buckets[-1][0]==bucket[0]:
+                            last=buckets[-1]
+                            count=last[4]+bucket[4]
+                            minimum,minimumtime=min((last[1],last[5]),(bucket[1],bucket[5]))
+                            maximum,maximumtime=max((last[2],-last[6]),(bucket[2],-bucket[6]))
+                            buckets[-1]=(last[0],minimum,maximum,(last[3]*last[4]+bucket[3]*bucket[4])/count,count,
+                                         minimumtime,-maximumtime)
+                        else:
+                            buckets.append(bucket)
+                return buckets
+
+            @staticmethod
+            def minmax(buckets:list) -> list:
+                ''' Convierte intervalos agregados en puntos de tendencia.
+
+                De cada intervalo se toman el mínimo y el máximo, para conservar los picos,
+                cada uno en el momento en que se alcanza y por tanto en orden. Si coinciden,
+                un solo punto.
+
+                Args:
+                buckets ([(int,float,float,float,int,int,int)]): Intervalos (ver get_buckets).
+
+                Returns ([[time(UNIX),[float]]):
+                Lista con pares tiempo (formato UNIX) y valor.
+
+                '''
+                results=[]
+                for start,minimum,maximum,average,count,minimumtime,maximumtime in buckets:
+                    points=[(minimumtime,minimum)]
+                    if maximum!=minimum:
+                        points=sorted(points+[(maximumtime,maximum)])
+                    for seconds,value in points:
+                        results.append([int(time.mktime(DBPLC.date(seconds).timetuple()))*1000,value])
+                return results
 
         def __init__(self, plc:PLC):
             self.table=Table()
+            self.lastdate=None
+            self.lastrows=Counter()
+            self.rollup={}
+            self.rolled={}
+            self.rolling=Lock()
             super().__init__(plc)
 
-        def set_row(self, dictionary:dict, date:datetime=None):
+        def create_rollups(self):
+            ''' Crea, si no existen, las tablas agregadas de la tabla (ver DBPLC.rollups).
+
+            '''
+            engine=self.plc.engine
+            metadata=MetaData()
+            for width,suffix in DBPLC.rollups:
+                columns=[self.table.name+"_"+suffix, metadata, Column("start",Integer,primary_key=True)]
+                for tag_key in self:
+                    for suffix,columntype in DBPLC.rollupcolumns:
+                        columns.append(Column(tag_key+suffix,columntype))
+                table=Table(*columns)
+                table.create(engine,checkfirst=True)
+                last=engine.execute(select([func.max(table.c.start)])).scalar()
+                self.rollup[width]=table
+                self.rolled[width]=None if last is None else last+width
+
+        def maintain(self):
+            ''' Añade a las tablas agregadas los intervalos completos que faltan.
+
+            Un intervalo está completo cuando hay algún registro posterior a su fin.
+            Los intervalos de un minuto se calculan de la tabla (ver Tag.get_buckets),
+            y los de cada resolución, de los de la anterior. Se avanza por tramos
+            de DBPLC.rollupchunk intervalos, de forma que rellenar un histórico largo
+            no carga toda la tabla de una vez, y lo ya agregado se conserva si se interrumpe.
+
+            Los registros que se insertan después con fechas ya agregadas
+            (ver set_row y Tag.set) hacen que se vuelvan a calcular sus intervalos (ver rewind).
+
+            '''
+            engine=self.plc.engine
+            with self.rolling:
+                newest=engine.execute(select([func.max(self.table.c.date)])).scalar()
+                if newest is None:
+                    return
+                now=DBPLC.seconds(newest)
+                source=None
+                for width,suffix in DBPLC.rollups:
+                    start=self.rolled[width]
+                    end=now-now%width
+                    if start is None:
+                        if source is None:
+                            first=DBPLC.seconds(engine.execute(select([func.min(self.table.c.date)])).scalar())
+                        else:
+                            first=engine.execute(select([func.min(self.rollup[source].c.start)])).scalar()
+                        start=None if first is None else first-first%width
+                    while not start is None and start<end:
+                        stop=min(end,start+width*DBPLC.rollupchunk)
+                        rows=self.aggregate(width,start,stop,source)
+                        if len(rows)>0:
+                            engine.execute(self.rollup[width].insert(),rows)
+                        self.rolled[width]=start=stop
+                    source=width
+
+        def rewind(self, date:datetime):
+            ''' Descarta los intervalos agregados desde una fecha, para que se vuelvan a calcular.
+
+            Se usa cuando se han insertado o corregido registros con fechas ya agregadas;
+            set_row y Tag.set lo llaman al insertar un registro con fecha. Sólo se borran
+            las tablas agregadas que ya llegan a esa fecha, y el siguiente maintain
+            vuelve a calcular sus intervalos.
+
+            Args:
+            date (datetime o str): Fecha del registro más antiguo que ha cambiado
+                (si es texto, en formato ISO, por ejemplo "2020-01-31 12:00:00").
+
+            '''
+            if len(self.rollup)==0:
+                return
+            if type(date)==str:
+                date=datetime.fromisoformat(date)
+            seconds=DBPLC.seconds(date)
+            with self.rolling:
+                for width,suffix in DBPLC.rollups:
+                    start=seconds-seconds%width
+                    if self.rolled[width] is None or self.rolled[width]<=start:
+                        continue
+                    table=self.rollup[width]
+                    self.plc.engine.execute(table.delete().where(table.c.start>=start))
+                    self.rolled[width]=start
+
+        def aggregate(self, width:int, start:int, end:int, source:int=None) -> list:
+            ''' Calcula los intervalos agregados de todas las variables.
+
+            Args:
+            width (int): Resolución en segundos.
+            start (int): Inicio del primer intervalo (None para empezar desde el principio).
+            end (int): Fin, excluido, del último intervalo.
+            source (int): Resolución de la tabla agregada de la que se parte
+                (None para partir de la tabla de registros).
+
+            Returns ({str:}[]):
+            Registros de la tabla agregada.
+
+            '''
+            empty={"start":None}
+            for tag_key in self:
+                for suffix,columntype in DBPLC.rollupcolumns:
+                    empty[tag_key+suffix]=None
+                empty[tag_key+"_count"]=0
+            rows={}
+            for tag_key in self:
+                if source is None:
+                    datefrom=DBPLC.date(0 if start is None else start)
+                    buckets=self.tag[tag_key].get_buckets(datefrom,DBPLC.date(end),width)
+                else:
+                    buckets=self.reaggregate(self.rollup[source],tag_key,width,start,end)
+                for bucket in buckets:
+                    row=rows.setdefault(bucket[0],dict(empty,start=bucket[0]))
+                    for (suffix,columntype),value in zip(DBPLC.rollupcolumns,bucket[1:]):
+                        row[tag_key+suffix]=value
+            return list(rows.values())
+
+        def reaggregate(self, table:Table, tag_key:str, width:int, start:int, end:int) -> list:
+            ''' Agrega los intervalos de una tabla agregada en intervalos mayores.
+
+            Args:
+            table (Table): Tabla agregada.
+            tag_key (str): Variable.
+            width (int): Segundos de cada intervalo, múltiplo de los de la tabla.
+            start (int): Inicio del primer intervalo (None para empezar desde el principio).
+            end (int): Fin, excluido, del último intervalo (None para no limitar).
+
+            Returns ([(int,float,float,float,int,int,int)]):
+            Intervalos, como en Tag.get_buckets.
+
+            '''
+            column=lambda suffix: table.c[tag_key+suffix]
+            count=column("_count")
+            bucket=table.c.start-table.c.start%width
+            s = select([bucket.label("start"),func.min(column("_min")).label("minimum"),func.max(column("_max")).label("maximum"),
+                        (func.sum(column("_avg")*count)/func.sum(count)).label("average"),func.sum(count).label("count"),
+                        func.min(table.c.start).label("first"),func.max(table.c.start).label("last")]).where(count>0)
+            if not start is None:
+                s = s.where(table.c.start>=start)
+            if not end is None:
+                s = s.where(table.c.start<end)
+            buckets = s.group_by(bucket).alias("buckets")
+            s = select([buckets.c.start,buckets.c.minimum,buckets.c.maximum,buckets.c.average,buckets.c.count,
+                        func.min(case([(column("_min")==buckets.c.minimum,column("_mintime"))])),
+                        func.min(case([(column("_max")==buckets.c.maximum,column("_maxtime"))]))]).select_from(
+                buckets.join(table,and_(table.c.start>=buckets.c.first,table.c.start<=buckets.c.last))).where(count>0).group_by(
+                buckets.c.start,buckets.c.minimum,buckets.c.maximum,buckets.c.average,buckets.c.count).order_by(buckets.c.start)
+            return [tuple(row) for row in self.plc.engine.execute(s).fetchall()]
+
+        def set_row(self, dictionary:dict, date:datetime=None) -> bool:
             ''' Inserta un regitro en la tabla.
 
+            Si la fecha ya está agregada, se vuelven a calcular sus intervalos (ver rewind).
+
             Args:
             dictionary ({str,float}): Valor de variables. Si no están todas, se inserta un nulo.
             date (datetime): Fecha y hora. Por defecto, la actual.
 
+            Returns (bool):
+            Verdadero si se ha insertado el registro.
+
             '''
             
-            if date==None:
-                date=func.now()
             plc=self.plc
-            if plc.connected:
-                try:
-                    d=dict({"date":date},**dictionary)
-                    i=self.table.insert().values(**d)
-                    i.compile().params  
-                    plc.engine.execute(i)
-                    for tag_key in self:
-                        if tag_key in dictionary.values():
-                            tag=self.tag[tag_key]
-                            value=dictionary[tag_key]
-                            tag.update(value)
-                except Exception as e:
-                    printexception(e,"Error writing to PLC")
+            if not plc.connected:
+                return False
+            try:
+                d=dict({"date":func.now() if date is None else date},**dictionary)
+                i=self.table.insert().values(**d)
+                i.compile().params  
+                plc.engine.execute(i)
+                if not date is None:
+                    self.rewind(date)
+                for tag_key in self:
+                    if tag_key in dictionary:
+                        tag=self.tag[tag_key]
+                        value=dictionary[tag_key]
+                        tag.update(value)
+                return True
+            except Exception as e:
+                printexception(e,"Error writing to PLC")
+                return False
 
         def get_row(self):
             ''' Devuelve el registro más reciente de la tabla.
@@ -161,72 +514,298 @@ class DBPLC(PLC):
             plc=self.plc
             if plc.connected:
                 try:
-                    s = select([self.table]).order_by(desc(text("date"))).limit(1)
-                    self.values=plc.engine.execute(s).fetchone()
+                    self.values=self.latest()
                     return self.values 
                 except Exception as e:
                     printexception(e,"Error reading from PLC")
 
+        def latest(self):
+            ''' Lee el registro más reciente de la tabla con una sola consulta.
 
-    def __init__(self, connection:str, pollingtime:float=0.0):
+            A diferencia de get_row, los errores se propagan.
+
+            Returns (RowProxy):
+            Registro, o None si la tabla está vacía.
+
+            '''
+            s = select([self.table]).order_by(desc(text("date"))).limit(1)
+            return self.plc.engine.execute(s).fetchone()
+
+        def newer(self) -> list:
+            ''' Lee los registros posteriores al último leído, en orden de fecha.
+
+            La primera vez sólo se lee el registro más reciente. Los errores se propagan.
+            Se leen también los registros con la misma fecha que el último leído,
+            descartando los que ya se habían leído (ver lastrows).
+
+            Returns (RowProxy[]):
+            Registros nuevos.
+
+            '''
+            if self.lastdate is None:
+                row=self.latest()
+                rows=[] if row is None else [row]
+            else:
+                s = select([self.table]).where(self.table.c.date>=self.lastdate).order_by(asc(self.table.c.date))
+                rows=[]
+                seen=Counter(self.lastrows)
+                for row in self.plc.engine.execute(s).fetchall():
+                    if row["date"]==self.lastdate and seen[tuple(row)]>0:
+                        seen[tuple(row)]-=1
+                    else:
+                        rows.append(row)
+            if len(rows)>0:
+                if rows[-1]["date"]!=self.lastdate:
+                    self.lastdate=rows[-1]["date"]
+                    self.lastrows=Counter()
+                for row in rows:
+                    if row["date"]==self.lastdate:
+                        self.lastrows[tuple(row)]+=1
+            return rows
+
+        def dispatch(self, row):
+            ''' Actualiza las variables con los valores de un registro.
+
+            Las columnas nulas no modifican la variable (ver Tag.set).
+
+            Args:
+            row (RowProxy): Registro de la tabla.
+
+            '''
+            for tag_key in self:
+                tag=self.tag[tag_key]
+                value=row[tag.column]
+                if not value is None:
+                    tag.update(value)
+
+
+    def __init__(self, connection:str, pollingtime:float=0.0, incremental:bool=False, maxpollingtime:float=5.0,
+                 rollup:bool=False, rolluptime:float=60.0):
         super().__init__()
         self.connection=connection
         self.pollingtime=pollingtime
+        self.incremental=incremental
+        self.maxpollingtime=maxpollingtime
+        self.idletime=pollingtime
+        self.rollup=rollup
+        self.rolluptime=rolluptime
         self.engine=create_engine(connection)
         self.thread=Thread(target=self.__Polling, args=())
+        self.rollupthread=Thread(target=self.__Rolling, args=(), daemon=True)
+        self.polling=True
 
     def connect(self):
         ''' Conexión con el controlador.
 
         '''
         self.thread.start()
+        if self.rollup:
+            self.rollupthread.start()
+
+    @staticmethod
+    def seconds(date:datetime) -> int:
+        ''' Segundos desde 1970 de una fecha, sin zona horaria (ver epoch).
+
+        Args:
+        date (datetime): Fecha y hora.
+
+        Returns (int):
+        Segundos.
+
+        '''
+        return int((date-datetime(1970,1,1)).total_seconds())
+
+    @staticmethod
+    def date(seconds:int) -> datetime:
+        ''' Fecha correspondiente a unos segundos desde 1970, sin zona horaria (ver epoch).
+
+        Args:
+        seconds (int): Segundos.
+
+        Returns (datetime):
+        Fecha y hora.
+
+        '''
+        return datetime(1970,1,1)+timedelta(seconds=seconds)
+
+    def maintain(self):
+        ''' Actualiza las tablas agregadas de todas las memorias (ver Memory.maintain).
+
+        '''
+        for key_memory in self.memory:
+            memory=self.memory[key_memory]
+            if len(memory.rollup)>0:
+                memory.maintain()
+
+    def write(self, values:dict) -> bool:
+        ''' Escritura de varias variables.
+
+        Como la fecha es la clave de las tablas, las variables de una misma
+        memoria se insertan juntas en un solo registro (ver Memory.set_row).
+
+        Args:
+        values ({Tag:valor}): Valores por variable.
+
+        Returns (bool):
+        Verdadero si se han insertado todos los registros.
+
+        '''
+        rows={}
+        for tag,value in values.items():
+            rows.setdefault(tag.memory,{})[tag.key]=value
+        result=True
+        self.begin()
+        try:
+            for memory,dictionary in rows.items():
+                if not memory.set_row(dictionary):
+                    result=False
+            return result
+        finally:
+            self.commit()
 
     def disconnect(self):
         ''' Termina la conexión con el controlador.
 
         ''' 
-        self.connected=false
+        self.connected=False
+
+    def epoch(self, column):
+        ''' Expresión SQL con los segundos desde 1970 de una columna de fecha.
+
+        La fecha se toma sin zona horaria, tal y como está guardada.
+
+        Args:
+        column: Columna de fecha.
+
+        Returns:
+        Expresión, o None si no se conoce el dialecto de la base de datos.
+
+        '''
+        dialect=self.engine.dialect.name
+        if dialect=="sqlite":
+            return func.strftime("%s",column)
+        if dialect=="postgresql":
+            return extract("epoch",column)
+        if dialect=="mysql":
+            return func.timestampdiff(literal_column("SECOND"),"1970-01-01",column)
+        return None
 
     def read(self):
-        ''' Lectura de todas las variables del controlador (datos más recientes de las tablas.
+        ''' Lectura de todas las variables del controlador (datos más recientes de las tablas).
+
+        Se hace una sola consulta por tabla (ver Memory.latest), y sus valores
+        se reparten entre las variables. Todos los cambios de un escaneo
+        se confirman en una sola transacción.
 
         '''
+        self.begin()
         try:
             for memory_key in self.memory:
                 memory=self.memory[memory_key]
-                for tag_key in memory:
-                    tag=memory.tag[tag_key]
-                    tag.get()
+                row=memory.latest()
+                memory.readtime=time.monotonic()
+                if not row is None:
+                    memory.dispatch(row)
+            self.responded()
+        except Exception as e:
+            self.disconnect()
+            self.failed()
+            printexception(e,"Error reading from PLC")
+        finally:
+            self.commit()
+
+    def read_incremental(self) -> int:
+        ''' Lectura de los registros nuevos de todas las tablas (ver Memory.newer).
 
+        Cada registro se confirma en su propia transacción y cierra su propio
+        ciclo de escaneo (ver PLC.endscan), de modo que los suscriptores,
+        incluidas las alarmas vectorizadas, reciben también los valores intermedios.
+
+        Returns (int):
+        Número de registros leídos.
+
+        '''
+        count=0
+        try:
+            for memory_key in self.memory:
+                memory=self.memory[memory_key]
+                rows=memory.newer()
+                memory.readtime=time.monotonic()
+                for row in rows:
+                    self.begin()
+                    try:
+                        memory.dispatch(row)
+                    finally:
+                        self.commit()
+                    self.endscan()
+                    count+=1
+            self.responded()
         except Exception as e:
             self.disconnect()
+            self.failed()
             printexception(e,"Error reading from PLC")
+        return count
+
+    def open(self) -> bool:
+        ''' Establece la conexión con la base de datos.
+        Si no existen la tablas, las crea de acuerdo a definición de variables y memoria.
+
+        Returns (bool):
+        Verdadero si se ha conectado.
+
+        '''
+        self.engine.connect().close()
+        for key_memory in self.memory:
+            memory=self.memory[key_memory]
+            metadata = MetaData()
+            columns=[key_memory, metadata, Column("date",DateTime,primary_key=True)]
+            for key_tag in self.memory[key_memory]:
+                tag=memory.tag[key_tag]
+                tag.column=Column(key_tag,Float)
+                columns.append(tag.column)
+            memory.table=Table(*columns)
+            memory.table.create(self.engine,checkfirst=True)
+            if self.rollup:
+                memory.create_rollups()
+        return True
 
     def __Polling(plc):
         ''' Lectura inicial y periódica de los valores más recientes.
-        Establece la conexión con la base de datos.
-        Si no existen la tablas, las crea de acuerdo a definición de variables y memoria.
+        Establece la conexión con la base de datos (ver open). Tras un intento
+        fallido se espera según la política de reintentos (ver PLC.backoff).
+        Las escrituras encoladas (ver PLC.queue) se ejecutan entre lecturas.
+        En modo incremental, la espera entre lecturas se alarga mientras
+        no llegan registros nuevos y vuelve a pollingtime en cuanto llegan.
 
         '''
         while True:
-            if plc.connected:
+            plc.flush()
+            if plc.connected and plc.incremental:
+                if plc.read_incremental()>0:
+                    plc.idletime=plc.pollingtime
+                else:
+                    plc.idletime=min(max(plc.idletime*2.0,0.05),plc.maxpollingtime)
+                if plc.idletime>0.0:
+                    plc.wait(plc.idletime)
+            elif plc.connected:
                 plc.read()
+                plc.endscan()
                 if plc.pollingtime>0.0:
-                    time.sleep(plc.pollingtime)
+                    plc.wait(plc.pollingtime)
+            elif plc.waittime()>0.0:
+                plc.wait(plc.waittime())
             else:
                 print("Connecting to DBPLC.")
-                plc.engine.connect()
-                plc.connected=True
-                for key_memory in plc.memory:
-                    memory=plc.memory[key_memory]
-                    metadata = MetaData()
-                    columns=[key_memory, metadata, Column("date",DateTime,primary_key=True)]
-                    for key_tag in plc.memory[key_memory]:
-                        tag=memory.tag[key_tag]
-                        tag.column=Column(key_tag,Float)
-                        columns.append(tag.column)
-                    memory.table=Table(*columns)
-                    memory.table.create(plc.engine,checkfirst=True)
-                        
-                
+                plc.attempt(plc.open)
 
+    def __Rolling(plc):
+        ''' Mantenimiento periódico de las tablas agregadas (ver maintain).
+
+        '''
+        while True:
+            if plc.connected:
+                try:
+                    plc.maintain()
+                except Exception as e:
+                    printexception(e,"Error updating rollup tables")
+            time.sleep(plc.rolluptime)
@@ -10,26 +10,36 @@ __version__="1.3"
 
 from TagModule import *
 from MBPLCModule import *
+from AMBPLCModule import *
 from OPCPLCModule import *
 from DBPLCModule import *
 from OutputModule import *
+from VectorModule import *
 import csv
 import time
 
 class Ensemble(object):
     ''' Motor del SCADA
 
+    Args:
+    vectorized (bool): Evalúa las alarmas sencillas con NumPy, una vez por ciclo de escaneo.
+
     Attributes:
     plc (PLC{}): Diccionario de controladores.
     tag (Tag{}): Diccionario de variables.
     alarmgroup (Alarmgroup{}): Diccionario de grupos de alarmas
+    vectorengine (VectorEngine): Motor de evaluación vectorizada (None si no se usa).
+    graph (ExpressionGraph): Grafo de dependencias de las expresiones.
 
     '''
     
-    def __init__(self):
+    def __init__(self, vectorized:bool=False):
         self.plc={}
         self.tag={}
         self.alarmgroup={}
+        self.vectorized=vectorized
+        self.vectorengine=None
+        self.graph=None
 
     def __setitem__(self, plc_key, plc:PLC):
         ''' Agrega un controlador al Ensemble.
@@ -138,6 +148,54 @@ class Ensemble(object):
         return self.alarmgroup[alarmgroup_key]
 
 
+    def write(self, values:dict) -> bool:
+        ''' Escritura de varias variables.
+
+        Agrupa las variables por controlador y escribe cada grupo de una vez (ver PLC.write).
+
+        Args:
+        values ({str:valor}): Valores por nombre de variable.
+
+        Returns (bool):
+        Verdadero si se han escrito todas las variables.
+
+        '''
+        groups={}
+        for tag_key,value in values.items():
+            tag=self.tag[tag_key]
+            if tag.memory is None:
+                raise Exception("Tag "+tag_key+" is not writable")
+            groups.setdefault(tag.memory.plc,{})[tag]=value
+        result=True
+        for plc,group in groups.items():
+            result=plc.write(group) and result
+        return result
+
+    def queue(self, values:dict, callback=None):
+        ''' Encola la escritura de varias variables sin esperar a que se realice.
+
+        Agrupa las variables por controlador (ver PLC.queue).
+
+        Args:
+        values ({str:valor}): Valores por nombre de variable.
+        callback: Función a la que se llama, por cada controlador, con la lista
+            de nombres de variables y el resultado (bool) de la escritura.
+
+        '''
+        groups={}
+        for tag_key,value in values.items():
+            tag=self.tag[tag_key]
+            if tag.memory is None:
+                raise Exception("Tag "+tag_key+" is not writable")
+            groups.setdefault(tag.memory.plc,({},[]))
+            groups[tag.memory.plc][0][tag]=value
+            groups[tag.memory.plc][1].append(tag_key)
+        for plc,(group,keys) in groups.items():
+            if callback is None:
+                plc.queue(group)
+            else:
+                plc.queue(group, lambda result, keys=keys: callback(keys, result))
+
     def deploy(self):
         '''  Despliegue rápido del motor.
 
@@ -155,7 +213,12 @@ class Ensemble(object):
 
         La primera línea del fichero contiene el encabezado.
         Las siguientes deben incluir los datos de las variables con formato:
-        [nombre];[plc];[memoria];[posición]
+        [nombre];[plc];[memoria];[posición];[descripción]
+        Las columnas adicionales son opciones de la variable, y se pasan por
+        el nombre de su encabezado (en minúsculas) al método configure de la variable.
+        Por ejemplo, la columna Scan indica la clase de escaneo de una variable Modbus.
+        Las opciones vacías se ignoran. La variable solo se añade a la memoria
+        si sus opciones son válidas.
 
         Args:
         filename (str): Ruta del fichero con las variables.
@@ -167,18 +230,22 @@ class Ensemble(object):
         '''
 
         with open(filename, newline="", encoding=encoding) as file:
-            next(file) # Saltamos la cabecera
             stream=csv.reader(file,delimiter=delimiter, quotechar=quotechar)
+            header=[column.strip().lower() for column in next(stream)]
             for row in stream:
                 tag_key=row[0]
                 plc_key=row[1]
                 memory_key=row[2]
                 address=row[3]
                 description=row[4]
+                options=dict([(header[i],row[i]) for i in range(5,min(len(header),len(row))) if len(row[i].strip())>0])
 
                 try:
-                    tag=self.plc[plc_key].memory[memory_key].create(prefix+tag_key,description,address)
-                    self.tag[tag_key]=tag
+                    memory=self.plc[plc_key].memory[memory_key]
+                    tag=memory.Tag(memory,prefix+tag_key,description,address)
+                    if len(options)>0:
+                        tag.configure(**options)
+                    self.tag[tag_key]=memory.set(prefix+tag_key,tag)
                 except Exception as e:
                     printexception(e,"Error importing tag "+prefix+tag_key+" to memory "+memory_key+" of PLC "+plc_key)
 
@@ -214,7 +281,20 @@ class Ensemble(object):
     def analyze_alarms(self):
         ''' Analiza todas las expresiones en el Ensemble.
 
-        '''    
+        En modo vectorizado, las alarmas sencillas se asignan al motor vectorial.
+        El resto de expresiones y alarmas forman un grafo de dependencias,
+        que las evalúa en orden topológico. Si hay referencias circulares
+        se lanza una excepción.
+
+        '''
+        if self.vectorized:
+            self.vectorengine=VectorEngine()
+        expressions=[tag for tag in self.tag.values() if isinstance(tag,Expression)]
         for alarmgroup_key,alarmgroup in self.alarmgroup.items():
-            for alarm in alarmgroup.alarm:
-                alarm.analyze()
+            expressions.extend(alarmgroup.alarm)
+        expressions=list(dict.fromkeys(expressions))
+        if not self.vectorengine is None:
+            expressions=[expression for expression in expressions
+                         if not isinstance(expression,Alarm) or not self.vectorengine.add(expression)]
+            self.vectorengine.build()
+        self.graph=ExpressionGraph(expressions)
@@ -6,12 +6,175 @@ __author__="José A. Casares"
 __date__="2016-02-14"
 __version__="1.3"
 
-from threading import Thread
+from threading import Thread, RLock, Event, Condition, current_thread
 from pymodbus3.client.sync import ModbusTcpClient as ModbusClient
+from pymodbus3.client.sync import ModbusSerialClient
+from pymodbus3.transaction import ModbusRtuFramer
 from TagModule import *
+import struct
 import time
 
 
+class MBBus(object):
+    """Línea Modbus multipunto (RS-485) compartida por varios esclavos.
+
+    Un único cliente y una única hebra leen por turnos los controladores
+    de la línea, dejando entre tramas el silencio que exige el protocolo.
+    Los controladores se crean con MBPLC(..., bus=línea).
+
+    Args:
+    port (str): Puerto serie (p. ej. /dev/ttyUSB0 o COM3), o dirección:puerto
+        de una pasarela TCP.
+    method (str): Formato de trama (rtu/ascii/binary). Con pasarela, rtu para tramas
+        RTU sobre TCP, o tcp para una pasarela Modbus TCP.
+    baudrate (int): Velocidad de la línea.
+    parity (str): Paridad (N/E/O).
+    stopbits (int): Bits de parada.
+    bytesize (int): Bits de datos.
+    timeout (float): Segundos de espera de una respuesta.
+    retries (int): Reintentos de lectura/escritura.
+    interframe (float): Segundos mínimos entre tramas. Por defecto, 3,5 caracteres
+        (1,75 ms a partir de 19200 baudios).
+
+    Attributes:
+    modbus (ModbusClient): Cliente Modbus de la línea.
+    client (Client): Fachada del cliente que usan los controladores.
+    plc (MBPLC[]): Controladores de la línea, en orden de turno.
+    lock (RLock): Exclusión de las peticiones a la línea.
+    lastframe (float): Momento (time.monotonic) en que terminó la última trama.
+    wakeup (Event): Despierta al escaneo cuando hay escrituras pendientes.
+    thread (Thread): Hebra de escaneo.
+
+    """
+
+    class Client(object):
+        """Fachada del cliente de una línea.
+
+        Serializa las peticiones de todos los controladores y espera el silencio
+        entre tramas antes de cada una. Cerrar la fachada no cierra la línea,
+        que sigue siendo usada por el resto de controladores.
+
+        Args:
+        bus (MBBus): Línea.
+
+        """
+
+        def __init__(self, bus:"MBBus"):
+            self.bus=bus
+
+        def __getattr__(self, name:str):
+            function=getattr(self.bus.modbus, name)
+            return lambda *args, **kwargs: self.bus.request(function, *args, **kwargs)
+
+        def close(self):
+            pass
+
+    def __init__(self, port:str, method:str="rtu", baudrate:int=9600, parity:str="N", stopbits:int=1,
+                 bytesize:int=8, timeout:float=1.0, retries:int=3, interframe:float=None):
+        if ":" in port and not port.startswith("/"):
+            host,tcpport=port.rsplit(":",1)
+            if method=="tcp":
+                self.modbus=ModbusClient(host, int(tcpport), retries=retries)
+            else:
+                self.modbus=ModbusClient(host, int(tcpport), framer=ModbusRtuFramer, retries=retries)
+        else:
+            self.modbus=ModbusSerialClient(method=method, port=port, baudrate=baudrate, parity=parity,
+                                           stopbits=stopbits, bytesize=bytesize, timeout=timeout, retries=retries)
+        self.port=port
+        if interframe is None:
+            interframe=3.5*11/baudrate if baudrate<=19200 else 0.00175
+        self.interframe=interframe
+        self.client=MBBus.Client(self)
+        self.plc=[]
+        self.lock=RLock()
+        self.lastframe=0.0
+        self.wakeup=Event()
+        self.thread=Thread(target=self.__Polling, args=(), daemon=True)
+
+    def request(self, function, *args, **kwargs):
+        ''' Ejecuta una petición en la línea, respetando el silencio entre tramas.
+
+        Args:
+        function: Método del cliente Modbus.
+        args: Argumentos del método.
+
+        Returns:
+        Respuesta.
+
+        '''
+        with self.lock:
+            delay=self.lastframe+self.interframe-time.monotonic()
+            if delay>0.0:
+                time.sleep(delay)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.lastframe=time.monotonic()
+
+    def add(self, plc:"MBPLC"):
+        ''' Añade un controlador a los turnos de la línea e inicia el escaneo.
+
+        Args:
+        plc (MBPLC): Controlador.
+
+        '''
+        plc.wakeup=self.wakeup
+        if not plc in self.plc:
+            self.plc.append(plc)
+        if not self.thread.is_alive():
+            self.thread.start()
+
+    def close(self):
+        ''' Cierra la línea.
+
+        '''
+        with self.lock:
+            self.modbus.close()
+
+    def wait(self, seconds:float):
+        ''' Espera el tiempo indicado, o hasta que algún controlador tenga escrituras pendientes.
+
+        Args:
+        seconds (float): Segundos máximos de espera.
+
+        '''
+        if self.wakeup.wait(seconds):
+            self.wakeup.clear()
+
+    def nextscan(self) -> float:
+        ''' Momento (time.monotonic) en que algún controlador necesita la línea.
+
+        Returns (float):
+        Momento de la próxima lectura o reintento de conexión.
+
+        '''
+        now=time.monotonic()
+        due=[plc.nextscan() if plc.connected else now+plc.waittime() for plc in self.plc]
+        return min(due) if len(due)>0 else now+1.0
+
+    def __Polling(bus):
+        ''' Escaneo por turnos de los controladores de la línea.
+
+        En cada vuelta, cada controlador ejecuta sus escrituras encoladas
+        y lee los bloques que han vencido. Un esclavo que no responde no cierra
+        la línea: se aparta según su política de reintentos (ver PLC.backoff)
+        mientras se sigue leyendo al resto. Como abrir el puerto compartido
+        siempre tiene éxito, los intentos fallidos de cada esclavo sólo se
+        reinician cuando éste responde (ver PLC.responded).
+
+        '''
+        while True:
+            for plc in list(bus.plc):
+                plc.flush()
+                if plc.connected:
+                    if plc.read(time.monotonic())>0 and plc.connected:
+                        plc.endscan()
+                elif plc.waittime()==0.0:
+                    print("Connecting to MBPLC "+bus.port+"("+str(plc.unit)+")")
+                    plc.attempt(plc.client.connect)
+            bus.wait(max(bus.nextscan()-time.monotonic(),0.0))
+
+
 class MBPLC(PLC):
     """PLC con comunicación Modbus.
 
@@ -23,6 +186,10 @@ class MBPLC(PLC):
     retries (int): Reintentos de lectura/escritura.
     client (ModbusClient): Cliente modbus.
     pollingtime (float): Segundos entre escaneos.
+    maxgap (int): Máximo número de direcciones sin variable que se leen
+        para no partir una petición en dos.
+    bus (MBBus): Línea multipunto compartida con otros esclavos. Si se indica,
+        se ignoran address, port, method y retries, y el escaneo lo hace la línea.
 
     Attributes:
     coil (Memory): Memoria de bobinas.
@@ -31,9 +198,24 @@ class MBPLC(PLC):
     register  (Memory): Memoria de registros de entrada.
     client (ModbusClient): Cliente Modbus.
     thread (Thread): Hebra de escaneo.
+    scanned (Condition): Avisa de cada lectura a las hebras que esperan por un bloque (ver fetch).
+    timeout (float): Segundos máximos de espera de una lectura fuera de turno (ver fetch).
+    datatypes ({str:(str,int,bool)}): Tipos de dato de los registros: código de struct,
+        número de registros y si el orden de las palabras está invertido
+        (palabra menos significativa primero).
     
     """
 
+    datatypes={
+        "int16":("h",1,False),
+        "uint16":("H",1,False),
+        "int32":("i",2,False),
+        "uint32":("I",2,False),
+        "float32":("f",2,False),
+        "int32_swap":("i",2,True),
+        "uint32_swap":("I",2,True),
+        "float32_swap":("f",2,True)}
+
     class COIL:
         """Tipo de memoria COIL."""
         pass
@@ -58,9 +240,78 @@ class MBPLC(PLC):
         Attributes:
         minindex (int): Dirección más baja de la memoria leída.
         maxindex (int): Dirección más alta de la memoria leída.
+        limit (int): Máximo número de elementos por petición según el protocolo
+            (2000 bits o 125 registros).
+        writelimit (int): Máximo número de elementos por petición de escritura
+            (1968 bits o 123 registros).
+        blocks (Block[]): Plan de lectura (None si debe recalcularse).
+        blockbyaddress (Block{}): Bloque del plan de lectura que lee cada dirección con variable.
+        function (str): Nombre del método del cliente Modbus que lee la memoria.
+        field (str): Atributo de la respuesta con los valores leídos (bits o registers).
 
         '''
 
+        class Block(object):
+            ''' Petición de lectura de un bloque de direcciones contiguas.
+
+            Args:
+            start (int): Dirección de inicio.
+            scantime (float): Segundos entre lecturas (None para el tiempo de escaneo del controlador).
+
+            count (int): Número de direcciones leídas.
+
+            Attributes:
+            addresses (int[]): Direcciones con variable.
+            due (float): Momento (time.monotonic) de la próxima lectura.
+            structure (Struct): Formato con el que se decodifican de una vez
+                todos los registros del bloque (None en memorias de bits).
+            fields ([(Tag,int)]): Variables decodificadas con structure y número de campos de cada una.
+            extra (Tag[]): Variables que se solapan con otras, decodificadas por separado.
+            buffer (bytes): Valores en bruto de la última lectura (None si aún no se ha leído).
+            stale (Tag{}): Variables cuyo valor puede no corresponder con buffer (escritas,
+                o cuyo último cambio no se aceptó), que se actualizan en la siguiente
+                lectura aunque sus registros no hayan cambiado.
+            readtime (float): Momento (time.monotonic) de la última lectura (ver PLC.maxage).
+
+            '''
+
+            def __init__(self, start:int, scantime:float=None, count:int=1):
+                self.start=start
+                self.count=count
+                self.addresses=[start]
+                self.scantime=scantime
+                self.due=0.0
+                self.structure=None
+                self.fields=[]
+                self.extra=[]
+                self.buffer=None
+                self.stale=set()
+                self.readtime=0.0
+
+            def compile(self, memory:PLC.Memory):
+                ''' Prepara la decodificación del bloque en una sola pasada.
+
+                Args:
+                memory (Memory): Memoria a la que pertenece el bloque.
+
+                '''
+                if memory.field=="bits":
+                    return
+                fmt=">"
+                position=self.start
+                for address in self.addresses:
+                    tag=memory.tagbyaddress[address]
+                    code,length,swap=tag.datatypes()
+                    if address<position:
+                        self.extra.append(tag)
+                        continue
+                    if address>position:
+                        fmt=fmt+str(2*(address-position))+"x"
+                    fmt=fmt+("HH" if swap else code)
+                    self.fields.append((tag,2 if swap else 1))
+                    position=address+length
+                self.structure=struct.Struct(fmt+str(2*(self.start+self.count-position))+"x")
+
         class Tag(PLC.Memory.Tag):
             ''' Variable de controlador Modbus.
 
@@ -73,44 +324,210 @@ class MBPLC(PLC):
             Attributes:
             value: Valor.
             subscriptor (Subcriptor[]): Objetos suscritos a los cambios.
+            scantime (float): Segundos entre lecturas (None para el tiempo de escaneo del controlador).
+            datatype (str): Tipo de dato de los registros (ver MBPLC.datatypes). None para
+                el registro sin transformar, o para bobinas y entradas.
+            length (int): Número de registros que ocupa.
+            scale (float): Factor de escala (None si no se usa).
+            offset (float): Desplazamiento, sumado después de la escala (None si no se usa).
             
             '''
 
+            __slots__=("scantime","datatype","length","scale","offset")
+
             def __init__(self, memory:PLC.Memory, key:str, description:str="", address=None):
                 if type(address)==str:
                     address=int(address)
+                self.scantime=None
+                self.datatype=None
+                self.length=1
+                self.scale=None
+                self.offset=None
                 super().__init__(memory,key,description,address)
                 if memory.minindex is None or memory.minindex>address:
                     memory.minindex=address
                 if memory.maxindex is None or memory.maxindex<address:
                     memory.maxindex=address
+
+            def configure(self, scan:str=None, scale:str=None, offset:str=None, **options):
+                ''' Configura opciones adicionales de la variable.
+
+                Args:
+                scan (str): Segundos entre lecturas (clase de escaneo).
+                type (str): Tipo de dato de los registros (ver MBPLC.datatypes).
+                scale (str): Factor de escala: valor=registro*scale+offset.
+                offset (str): Desplazamiento.
+                options ({str:str}): Resto de opciones.
+
+                '''
+                datatype=options.pop("type",None)
+                if scan:
+                    self.scantime=float(scan)
+                    self.memory.blocks=None
+                if datatype or scale or offset:
+                    if self.memory.field=="bits":
+                        raise Exception("Data type and scaling only apply to registers: "+str(self.key))
+                    if datatype:
+                        if not datatype.lower() in MBPLC.datatypes:
+                            raise Exception("Unknown Modbus data type "+datatype+" for tag "+str(self.key))
+                        self.datatype=datatype.lower()
+                        self.length=MBPLC.datatypes[self.datatype][1]
+                        self.memory.blocks=None
+                    if scale:
+                        self.scale=float(scale)
+                    if offset:
+                        self.offset=float(offset)
+                super().configure(**options)
+
+            def datatypes(self) -> tuple:
+                ''' Devuelve la descripción del tipo de dato (ver MBPLC.datatypes).
+
+                Returns ((str,int,bool)):
+                Código de struct, número de registros y orden de palabras invertido.
+
+                '''
+                return MBPLC.datatypes[self.datatype or "uint16"]
+
+            def decode(self, registers:list):
+                ''' Decodifica el valor de la variable a partir de sus registros.
+
+                Args:
+                registers (int[]): Registros (length elementos).
+
+                Returns:
+                Valor en bruto, sin escala.
+
+                '''
+                code,length,swap=self.datatypes()
+                if swap:
+                    registers=registers[::-1]
+                return struct.unpack(">"+code,struct.pack(">"+str(length)+"H",*registers))[0]
+
+            def encode(self, value) -> list:
+                ''' Codifica un valor en los registros de la variable, deshaciendo la escala.
+
+                Args:
+                value: Valor.
+
+                Returns (int[]):
+                Registros.
+
+                '''
+                code,length,swap=self.datatypes()
+                if not self.scale is None or not self.offset is None:
+                    value=(value-(self.offset or 0.0))/(1.0 if self.scale is None else self.scale)
+                if code!="f":
+                    value=int(round(value))
+                registers=list(struct.unpack(">"+str(length)+"H",struct.pack(">"+code,value)))
+                if swap:
+                    registers=registers[::-1]
+                return registers
+
+            def scaled(self, raw):
+                ''' Aplica la escala y el desplazamiento a un valor en bruto.
+
+                Args:
+                raw: Valor en bruto.
+
+                Returns:
+                Valor de la variable.
+
+                '''
+                if self.scale is None and self.offset is None:
+                    return raw
+                return raw*(1.0 if self.scale is None else self.scale)+(self.offset or 0.0)
                 
-            def set(self, value):
+            def set(self, value) -> bool:
                 ''' Modifica el valor de una variable.
 
                 Args:
                 value: Nuevo valor de la variable.
 
+                Returns (bool):
+                Verdadero si se ha escrito el valor.
+
                 '''
 
                 plc=self.memory.plc
-                if plc.connected:
-                    try:
-                        if self.memory.memorytype==MBPLC.COIL:
-                            if isinstance(value,str):
-                                if value.upper()=="TRUE" or value=="1":
-                                    value=True
-                                elif value.upper()=="FALSE" or value=="0":
-                                    value=False
-                            rw = plc.client.write_coil(self.address,value,unit=plc.unit)
-                        if self.memory.memorytype==MBPLC.HOLDING:
-                            if isinstance(value,str):
-                                value=int(value)
-                            rw = plc.client.write_register(self.address,value,unit=plc.unit)
-                        self.update(value)
-                    except Exception as e:
-                        self.memory.plc.connected=False
-                        printexception(e,"Error writing to PLC")
+                if not plc.connected or not self.memory.memorytype in (MBPLC.COIL, MBPLC.HOLDING):
+                    return False
+                try:
+                    value=self.convert(value)
+                    if self.memory.memorytype==MBPLC.COIL:
+                        rw = plc.client.write_coil(self.address,value,unit=plc.unit)
+                    if self.memory.memorytype==MBPLC.HOLDING:
+                        registers=self.encode(value)
+                        if len(registers)==1:
+                            rw = plc.client.write_register(self.address,registers[0],unit=plc.unit)
+                        else:
+                            rw = plc.client.write_registers(self.address,registers,unit=plc.unit)
+                    self.update(value)
+                    self.memory.invalidate(self)
+                    return True
+                except Exception as e:
+                    self.memory.plc.connected=False
+                    printexception(e,"Error writing to PLC")
+                    return False
+
+            def lastread(self) -> float:
+                ''' Momento (time.monotonic) de la última lectura del bloque de la variable.
+
+                Returns (float):
+                Momento de la lectura.
+
+                '''
+                block=self.memory.block(self)
+                return self.memory.readtime if block is None else block.readtime
+
+            def refresh(self):
+                ''' Lee del controlador el bloque de la variable y la actualiza.
+
+                La lectura la hace la hebra de escaneo (ver MBPLC.fetch), porque
+                el cliente Modbus no admite peticiones desde varias hebras a la vez.
+
+                Returns:
+                Valor de la variable.
+
+                '''
+                memory=self.memory
+                block=memory.block(self)
+                if not block is None and memory.plc.connected:
+                    memory.plc.fetch(memory,block)
+                return self.value
+
+            def request(self):
+                ''' Adelanta la lectura del bloque de la variable, sin esperar a que se haga.
+
+                '''
+                block=self.memory.block(self)
+                if not block is None:
+                    block.due=0.0
+                    self.memory.plc.wake()
+
+            def convert(self, value):
+                ''' Convierte un valor (por ejemplo, recibido como texto) al tipo de la memoria.
+
+                Args:
+                value: Valor.
+
+                Returns:
+                Valor convertido: bool para bobinas; int para registros, o float si
+                el tipo es de coma flotante o se aplica escala.
+
+                '''
+                if self.memory.memorytype==MBPLC.COIL:
+                    if isinstance(value,str):
+                        if value.upper()=="TRUE" or value=="1":
+                            value=True
+                        elif value.upper()=="FALSE" or value=="0":
+                            value=False
+                if self.memory.memorytype==MBPLC.HOLDING:
+                    if isinstance(value,str):
+                        if self.datatypes()[0]=="f" or not self.scale is None or not self.offset is None:
+                            value=float(value)
+                        else:
+                            value=int(value)
+                return value
                         
 
                 
@@ -118,10 +535,157 @@ class MBPLC(PLC):
             self.memorytype=memorytype
             self.minindex=None
             self.maxindex=None
+            self.limit=2000 if memorytype in (MBPLC.COIL, MBPLC.INPUT) else 125
+            self.writelimit=1968 if memorytype in (MBPLC.COIL, MBPLC.INPUT) else 123
+            self.blocks=None
+            self.blockbyaddress={}
+            self.function={MBPLC.COIL:"read_coils", MBPLC.INPUT:"read_discrete_inputs",
+                MBPLC.HOLDING:"read_holding_registers", MBPLC.REGISTER:"read_input_registers"}[memorytype]
+            self.field="bits" if memorytype in (MBPLC.COIL, MBPLC.INPUT) else "registers"
             super().__init__(plc)
+
+        def set(self, tag_key, tag:PLC.Memory.Tag) -> PLC.Memory.Tag:
+            ''' Modifica o asigna una variable a la memoria.
+
+            Invalida el plan de lectura.
+
+            Args:
+            tag_key: Nombre o identificador de la variable.
+            tag (Tag): Variable.
+
+            Returns (Tag):
+            La propia variable.
+
+            '''
+            self.blocks=None
+            return super().set(tag_key, tag)
+
+        def plan(self) -> list:
+            ''' Devuelve el plan de lectura de la memoria, calculándolo si es necesario.
+
+            Las direcciones se agrupan por tiempo de escaneo, y dentro de cada grupo
+            en bloques contiguos; se empieza un bloque nuevo cuando el hueco hasta
+            la siguiente dirección supera maxgap del controlador, o cuando el bloque
+            superaría el límite del protocolo. Las variables de 32 bits ocupan
+            dos registros.
+
+            Returns (Block[]):
+            Peticiones de lectura.
+
+            '''
+            if self.blocks is None:
+                blocks=[]
+                groups={}
+                for address in sorted(self.tagbyaddress):
+                    groups.setdefault(self.tagbyaddress[address].scantime,[]).append(address)
+                for scantime,addresses in groups.items():
+                    block=None
+                    for address in addresses:
+                        end=address+self.tagbyaddress[address].length
+                        if not block is None and address-(block.start+block.count)<=self.plc.maxgap and end-block.start<=self.limit:
+                            block.count=max(block.count,end-block.start)
+                            block.addresses.append(address)
+                        else:
+                            block=MBPLC.Memory.Block(address,scantime,end-address)
+                            blocks.append(block)
+                for block in blocks:
+                    block.compile(self)
+                self.blockbyaddress={address:block for block in blocks for address in block.addresses}
+                self.blocks=blocks
+            return self.blocks
+
+        def block(self, tag:PLC.Memory.Tag) -> Block:
+            ''' Devuelve el bloque del plan de lectura que lee una variable.
+
+            Args:
+            tag (Tag): Variable.
+
+            Returns (Block):
+            Bloque (None si la variable no es de la memoria).
+
+            '''
+            self.plan()
+            return self.blockbyaddress.get(tag.address)
+
+        def invalidate(self, tag:PLC.Memory.Tag):
+            ''' Obliga a actualizar una variable en la siguiente lectura de su bloque.
+
+            Se usa cuando el valor de la variable deja de corresponder con la última
+            lectura en bruto, por ejemplo tras escribirla.
+
+            Args:
+            tag (Tag): Variable.
+
+            '''
+            block=self.block(tag)
+            if not block is None:
+                block.stale.add(tag)
+
+        def dispatch(self, block:Block, values:list):
+            ''' Actualiza las variables con los valores leídos en una petición.
+
+            La respuesta se compara en bruto con la lectura anterior del mismo bloque:
+            si no ha cambiado no se hace nada más, y si ha cambiado sólo se actualizan
+            las variables cuyos bits o registros son distintos. Las variables del bloque
+            marcadas como no actualizadas (ver invalidate), o cuyo cambio no se acepta
+            (ver Tag.accept), se actualizan siempre en las siguientes lecturas, hasta que
+            su valor corresponde con el leído. Los registros se decodifican de una vez
+            con el formato del bloque (ver Block.compile), y después se aplica la escala
+            de cada variable.
+
+            Args:
+            block (Block): Petición.
+            values ([]): Valores leídos (bits o registros).
+
+            '''
+            if block.structure is None:
+                buffer=bytes(values[:block.count])
+            else:
+                buffer=struct.pack(">"+str(block.count)+"H",*values[:block.count])
+            previous=block.buffer
+            if buffer==previous and len(block.stale)==0:
+                return
+            block.buffer=buffer
+            if block.structure is None:
+                for address in block.addresses:
+                    position=address-block.start
+                    tag=self.tagbyaddress[address]
+                    if previous is None or buffer[position]!=previous[position] or tag in block.stale:
+                        self.refreshed(block,tag,values[position])
+                return
+            decoded=block.structure.unpack(buffer)
+            i=0
+            for tag,fields in block.fields:
+                position=2*(tag.address-block.start)
+                end=position+2*tag.length
+                if previous is None or buffer[position:end]!=previous[position:end] or tag in block.stale:
+                    if fields==1:
+                        self.refreshed(block,tag,tag.scaled(decoded[i]))
+                    else:
+                        self.refreshed(block,tag,tag.scaled(tag.decode(decoded[i:i+fields])))
+                i+=fields
+            for tag in block.extra:
+                position=tag.address-block.start
+                self.refreshed(block,tag,tag.scaled(tag.decode(values[position:position+tag.length])))
+
+        def refreshed(self, block:Block, tag:PLC.Memory.Tag, value):
+            ''' Actualiza una variable con el valor leído y anota si ha quedado pendiente.
+
+            Args:
+            block (Block): Bloque leído.
+            tag (Tag): Variable.
+            value: Valor leído.
+
+            '''
+            tag.update(value)
+            if tag.value==value:
+                block.stale.discard(tag)
+            else:
+                block.stale.add(tag)
     
 
-    def __init__(self, address:str, port:int=502, unit:int=1, method:str="rtu", retries:int=3, pollingtime:float=1.0):
+    def __init__(self, address:str=None, port:int=502, unit:int=1, method:str="rtu", retries:int=3, pollingtime:float=1.0, maxgap:int=16,
+                 bus:MBBus=None):
         super().__init__()
         self.coil=self.create("coil",MBPLC.COIL)
         self.input=self.create("input",MBPLC.INPUT)
@@ -133,8 +697,16 @@ class MBPLC(PLC):
         self.method=method
         self.retries=retries
         self.pollingtime=pollingtime
-        self.client = ModbusClient(address, port, method=method, retries=retries)
+        self.maxgap=maxgap
+        self.bus=bus
+        if bus is None:
+            self.client = ModbusClient(address, port, method=method, retries=retries)
+        else:
+            self.client = bus.client
         self.thread=Thread(target=self.__Polling, args=())
+        self.scanned=Condition()
+        self.timeout=3.0
+        self.polling=True
 
     def create(self,memory_key, memorytype:type):
         ''' Crea una memoria en el controlador.
@@ -153,59 +725,224 @@ class MBPLC(PLC):
         ''' Conexión con el controlador
 
         '''
-        self.thread.start()
+        if self.bus is None:
+            self.thread.start()
+        else:
+            self.bus.add(self)
 
     def disconnect(self):
         ''' Termina la conexión con el controlador.
 
         ''' 
-        self.connected=false
+        self.connected=False
         self.client.close()
 
-    def read(self):
-        ''' Lectura de un área de memoria del controlador real.
+    def write(self, values:dict) -> bool:
+        ''' Escritura de varias variables.
+
+        Las direcciones contiguas de una misma memoria se agrupan en peticiones
+        (ver runs), respetando el límite del protocolo.
+        Después se actualizan las variables en una sola transacción.
+        Si alguna variable no es de una memoria escribible, no se escribe ninguna.
 
-        Si falla la lectura (tras el número de reintentos)
-        se actualiza el estado de conexión a desconectado.
+        Args:
+        values ({Tag:valor}): Valores por variable.
+
+        Returns (bool):
+        Verdadero si se han escrito todas las variables.
 
         '''
+        if not self.connected:
+            return False
+        try:
+            requests=self.runs(values)
+        except Exception as e:
+            printexception(e,"Error writing to PLC")
+            return False
+        self.begin()
         try:
-            if not self.coil.minindex is None:
-                rr = self.client.read_coils(self.coil.minindex, self.coil.maxindex-self.coil.minindex+1,unit=self.unit)
-                for i in range(self.coil.minindex,self.coil.maxindex+1):
-                    if i in self.coil.tagbyaddress:
-                        self.coil.tagbyaddress[i].update(rr.bits[i-self.coil.minindex])
-            if not self.input.minindex is None:                
-                rr = self.client.read_discrete_inputs(self.input.minindex, self.input.maxindex-self.input.minindex+1,unit=self.unit)
-                for i in range(self.input.minindex,self.input.maxindex+1):
-                    if i in self.input.tagbyaddress:
-                        self.input.tagbyaddress[i].update(rr.bits[i-self.input.minindex])
-            if not self.holding.minindex is None:                    
-                rr = self.client.read_holding_registers(self.holding.minindex, self.holding.maxindex-self.holding.minindex+1,unit=self.unit)
-                for i in range(self.holding.minindex,self.holding.maxindex+1):
-                    if i in self.holding.tagbyaddress:
-                        self.holding.tagbyaddress[i].update(rr.registers[i-self.holding.minindex])
-            if not self.register.minindex is None:                    
-                rr = self.client.read_input_registers(self.register.minindex, self.register.maxindex-self.register.minindex+1,unit=self.unit)
-                for i in range(self.register.minindex,self.register.maxindex+1):
-                    if i in self.register.tagbyaddress:
-                        self.register.tagbyaddress[i].update(rr.registers[i-self.register.minindex])
+            for function,start,run,converted,raw in requests:
+                getattr(self.client,function)(start,raw,unit=self.unit)
+                for tag,value in zip(run,converted):
+                    tag.update(value)
+                    tag.memory.invalidate(tag)
+            return True
         except Exception as e:
-            self.coil.plc.disconnect()
+            self.connected=False
+            printexception(e,"Error writing to PLC")
+            return False
+        finally:
+            self.commit()
+
+    def runs(self, values:dict) -> list:
+        ''' Agrupa escrituras en peticiones de direcciones contiguas.
+
+        Las peticiones de un solo bit o un solo registro usan write_coil o
+        write_register (funciones 5 y 6), que admiten todos los dispositivos;
+        las demás, write_coils o write_registers (funciones 15 y 16).
+
+        Args:
+        values ({Tag:valor}): Valores por variable.
+
+        Returns ([(str,int,Tag[],[],[] o int)]):
+        Método del cliente, dirección de inicio, variables, valores convertidos
+        y valor o valores a escribir (bits o registros) de cada petición.
+
+        '''
+        for tag in values:
+            if not tag.memory in (self.coil, self.holding):
+                raise Exception("Tag "+str(tag.key)+" is not in a writable memory")
+        requests=[]
+        for memory,function in ((self.coil,"write_coils"),(self.holding,"write_registers")):
+            tags=sorted([tag for tag in values if tag.memory is memory], key=lambda tag: tag.address)
+            while len(tags)>0:
+                run=[tags.pop(0)]
+                count=run[0].length
+                while len(tags)>0 and tags[0].address==run[-1].address+run[-1].length and count+tags[0].length<=memory.writelimit:
+                    count+=tags[0].length
+                    run.append(tags.pop(0))
+                converted=[tag.convert(values[tag]) for tag in run]
+                if memory is self.coil:
+                    raw=converted
+                else:
+                    raw=[register for tag,value in zip(run,converted) for register in tag.encode(value)]
+                if len(raw)==1:
+                    requests.append((function[:-1],run[0].address,run,converted,raw[0]))
+                else:
+                    requests.append((function,run[0].address,run,converted,raw))
+        return requests
+
+    def read(self, now:float=None):
+        ''' Lectura de las áreas de memoria del controlador real.
+
+        Cada área se lee según su plan de lectura (ver Memory.plan).
+        Si falla la lectura (tras el número de reintentos) se cierra la conexión
+        y se espera según la política de reintentos (ver PLC.failed).
+        Todos los cambios de un escaneo se confirman en una sola transacción.
+
+        Args:
+        now (float): Momento actual (time.monotonic). Si se indica, sólo se leen
+            los bloques cuya próxima lectura ha vencido. Si no, se leen todos.
+
+        Returns (int):
+        Número de bloques leídos.
+
+        '''
+        return self.readblocks(self.due(now))
+
+    def readblocks(self, requests:list) -> int:
+        ''' Lectura de una lista de bloques (ver read).
+
+        Al terminar se avisa a las hebras que esperan por algún bloque (ver fetch).
+
+        Args:
+        requests ([(Memory,Block)]): Memoria y bloque de cada petición.
+
+        Returns (int):
+        Número de bloques leídos.
+
+        '''
+        count=0
+        self.begin()
+        try:
+            for memory,block in requests:
+                rr = getattr(self.client,memory.function)(block.start,block.count,unit=self.unit)
+                memory.dispatch(block,getattr(rr,memory.field))
+                block.readtime=memory.readtime=time.monotonic()
+                self.responded()
+                count+=1
+        except Exception as e:
+            self.disconnect()
+            self.failed()
             printexception(e,"Error reading from PLC")
+        finally:
+            self.commit()
+            with self.scanned:
+                self.scanned.notify_all()
+        return count
+
+    def scanning(self) -> bool:
+        ''' Indica si la hebra actual es la de escaneo del controlador (o de su línea).
+
+        Returns (bool):
+        Verdadero si es la hebra de escaneo.
+
+        '''
+        return current_thread() is (self.thread if self.bus is None else self.bus.thread)
+
+    def fetch(self, memory:Memory, block:Memory.Block):
+        ''' Lee un bloque fuera de turno (ver Tag.refresh).
+
+        Desde la hebra de escaneo el bloque se lee directamente. Desde otra hebra,
+        se adelanta su lectura, se despierta al escaneo y se espera, como mucho
+        timeout segundos, a que lo haya leído.
+
+        Args:
+        memory (Memory): Memoria del bloque.
+        block (Block): Bloque.
+
+        '''
+        if self.scanning():
+            self.readblocks([(memory,block)])
+            return
+        requested=time.monotonic()
+        block.due=0.0
+        self.wake()
+        with self.scanned:
+            self.scanned.wait_for(lambda: block.readtime>=requested or not self.connected, self.timeout)
+
+    def due(self, now:float=None) -> list:
+        ''' Devuelve los bloques que deben leerse y programa su próxima lectura.
+
+        Args:
+        now (float): Momento actual (time.monotonic). Si es None, se devuelven todos.
+
+        Returns ([(Memory,Block)]):
+        Memoria y bloque de cada petición.
+
+        '''
+        requests=[]
+        for memory in (self.coil, self.input, self.holding, self.register):
+            for block in memory.plan():
+                if now is None or block.due<=now:
+                    requests.append((memory,block))
+                    if not now is None:
+                        scantime=self.pollingtime if block.scantime is None else block.scantime
+                        block.due=block.due+scantime
+                        if block.due<=now:  # Ciclos perdidos: no se acumula retraso.
+                            block.due=now+scantime
+        return requests
+
+    def nextscan(self) -> float:
+        ''' Momento (time.monotonic) en que vence la próxima lectura de algún bloque.
+
+        Returns (float):
+        Momento de la próxima lectura.
+
+        '''
+        due=[block.due for memory in (self.coil, self.input, self.holding, self.register) for block in memory.plan()]
+        return min(due) if len(due)>0 else time.monotonic()+self.pollingtime
 
     def __Polling(plc):
         ''' Lectura de todas las áreas de escaneo.
 
+        Cada bloque se lee cuando vence su tiempo de escaneo.
         Establece la conexión con los controladores,
-        si no se ha hecho antes, o se ha perdido.
+        si no se ha hecho antes, o se ha perdido. Tras un intento fallido
+        se espera según la política de reintentos (ver PLC.backoff).
+        Las escrituras encoladas (ver PLC.queue) se ejecutan entre escaneos,
+        y las esperas se interrumpen en cuanto hay alguna.
 
         '''
         while True:
+            plc.flush()
             if plc.connected:
-                plc.read()
-                time.sleep(plc.pollingtime)
+                plc.read(time.monotonic())
+                plc.endscan()
+                plc.wait(max(plc.nextscan()-time.monotonic(),0.0))
+            elif plc.waittime()>0.0:
+                plc.wait(plc.waittime())
             else:
                 print("Connecting to MBPLC "+plc.address+":"+str(plc.port)+"("+str(plc.unit)+")")
-                plc.connected=plc.client.connect()
+                plc.attempt(plc.client.connect)
 
@@ -6,9 +6,12 @@ __author__="José A. Casares"
 __date__="2016-02-14"
 __version__="1.3"
 
-from threading import Thread
+from threading import Thread, Lock, Event
 from TagModule import *
 import time
+import json
+import os
+import tempfile
 from opcua import ua, Client
 
 
@@ -19,16 +22,29 @@ class OPCPLC(PLC):
     address (str): Dirección IP (o nombre) del controlador.
     port (int): Puerto de conexión.
     interval (float): Intervalo de actualización en segundos.
+    batchsize (int): Máximo número de nodos por petición al suscribir variables.
+    cachefile (str): Fichero donde se guardan los nodos y tipos de dato resueltos
+        (None para no guardarlos). Se comparte entre controladores: cada servidor
+        tiene su propia entrada, identificada por su dirección y su tabla de espacios de nombres.
+    keepalive (float): Segundos entre comprobaciones de la conexión (ver check).
+    queuesize (int): Máximo número de nodos con cambios pendientes de aplicar (ver Handler).
 
     Attributes:
+    nodecache ({str:[str,int]}): Identificador de nodo y tipo de dato por dirección de variable.
+    cachekey (str): Entrada del servidor en el fichero de caché.
+    keepalive (float): Segundos entre comprobaciones de la conexión.
+    lastkeepalive (float): Momento (time.monotonic) de la última comprobación.
+    thread (Thread): Hebra de supervisión de la conexión.
     subscription: Grupo al que se suscriben las variables.
     handler: Manejador de las actualizaciones de los valores.
     objects: Nodo de objetos.
     tagbynodeid (Tag{}): Diccionario de variables por identificador de nodo.
     client: Cliente OPC UA.
     opctype (VariantType{}): Principales tipos de datos OPC.
+    cachelock (Lock): Exclusión entre los controladores que guardan la caché.
     
     """
+    cachelock=Lock()
     opctype={
         1:ua.VariantType.Boolean,
         2:ua.VariantType.SByte,
@@ -79,6 +95,8 @@ class OPCPLC(PLC):
             
             '''
 
+            __slots__=("node","type")
+
             def __init__(self, memory:PLC.Memory, key:str, description:str="", address=None):
                 self.node=None
                 self.type=None
@@ -88,21 +106,33 @@ class OPCPLC(PLC):
                 ''' Suscripción al nodo OPC.
 
                 '''
-                plc=self.memory.plc
-                address=self.address.split("\\")
-                self.node=plc.objects.get_child(address)
-                self.type=int(self.node.get_data_type().Identifier)
-                plc.tagbynodeid[self.node.nodeid.Identifier]=self
-                plc.subscription.subscribe_data_change(self.node)
-                self.node.get_value()
-
-            def set(self,value):
+                self.memory.plc.opcsubscribe([self])
+
+            def refresh(self):
+                ''' Lee el valor del nodo OPC y lo actualiza.
+
+                Returns:
+                Valor de la variable.
+
+                '''
+                try:
+                    self.update(self.node.get_value())
+                except Exception as e:
+                    printexception(e,"Error reading from OPC server. Tag="+str(self.key))
+                return self.value
+
+            def set(self,value) -> bool:
                 ''' Modifica o asigna el valor de una variable.
 
                 Args:
                 value: Nuevo valor de la variable.
 
+                Returns (bool):
+                Verdadero si se ha escrito el valor en el servidor.
+
                 '''
+                if not self.memory.plc.connected:
+                    return False
                 try:
                     if self.type==1:
                         self.node.set_value(ua.Variant(bool(value),OPCPLC.opctype[self.type])) 
@@ -115,38 +145,285 @@ class OPCPLC(PLC):
                     if self.type==13:
                         self.node.set_value(ua.Variant(datetime.strptime(value,"%Y-%m-%d %H:%M:%S"),OPCPLC.opctype[self.type]))
 
-                    self.__update(value)
+                    self.update(value)
+                    return True
                 except Exception as e:
-                    printexception(e,"Error in assignment. Tag="+self.key+", Value="+value)
+                    printexception(e,"Error in assignment. Tag="+str(self.key)+", Value="+str(value))
+                    return False
 
 
-    def __init__(self, address:str, port:int=502, interval:float=3):
+    def __init__(self, address:str, port:int=502, interval:float=3, batchsize:int=1000, cachefile:str=None,
+                 keepalive:float=5.0, queuesize:int=100000):
         super().__init__()
         self.address=address
         self.port=port
         self.interval=interval
-        self.handler=OPCPLC.Handler(self)
+        self.batchsize=batchsize
+        self.cachefile=cachefile
+        self.nodecache={}
+        self.cachekey=None
+        self.keepalive=keepalive
+        self.lastkeepalive=0.0
+        self.handler=OPCPLC.Handler(self,queuesize)
         self.subscription=None
         self.objects=None
         self.tagbynodeid={}
         self.client = Client("opc.tcp://"+self.address+":"+str(self.port)+"/")
         self.create("")
+        self.thread=Thread(target=self.__Supervising, args=())
+        self.polling=True
 
     def connect(self):
-        ''' Conexión con el controlador
+        ''' Conexión con el controlador.
+
+        La conexión se establece, y se restablece si se pierde, desde la hebra de supervisión.
+
+        '''
+        self.thread.start()
+
+    def disconnect(self):
+        ''' Termina la conexión con el controlador.
+
+        '''
+        self.connected=False
+        self.close()
+
+    def close(self):
+        ''' Cierra el cliente actual, esté o no conectado, sin lanzar excepciones.
+
+        '''
+        try:
+            self.client.disconnect()
+        except Exception:
+            try:
+                self.client.disconnect_socket()
+            except Exception:
+                pass
+
+    def open(self) -> bool:
+        ''' Establece la conexión con el servidor y suscribe todas las variables.
+
+        En cada intento se cierra el cliente anterior (ver close), para no dejar
+        abiertas su sesión ni sus hebras, y se crea uno nuevo. Los nodos se toman de la caché
+        (ver opcsubscribe), que se conserva entre reconexiones mientras no cambie
+        la tabla de espacios de nombres del servidor.
+
+        Returns (bool):
+        Verdadero si se ha conectado.
+
+        '''
+        self.close()
+        self.client=Client("opc.tcp://"+self.address+":"+str(self.port)+"/")
+        self.client.connect()
+        self.objects=self.client.get_objects_node()
+        self.loadcache()
+        self.subscription=self.client.create_subscription(self.interval, self.handler)
+        tags=[]
+        for key_memory in self.memory:
+            memory=self.get(key_memory)
+            for key_tag in memory:
+                tags.append(memory.get(key_tag))
+        self.opcsubscribe(tags)
+        self.lastkeepalive=time.monotonic()
+        for key_memory in self.memory:
+            self.get(key_memory).readtime=self.lastkeepalive
+        return True
+
+    def check(self):
+        ''' Comprueba la conexión leyendo el estado del servidor.
+
+        Si la lectura falla, o el servidor no está en marcha, se da la conexión
+        por perdida, se cierra el cliente y la hebra de supervisión reconecta
+        según la política de reintentos (ver PLC.failed). Si no, la suscripción
+        sigue activa y los valores en caché se consideran leídos del origen
+        (ver PLC.maxage).
 
         '''
+        self.lastkeepalive=time.monotonic()
         try:
-            self.client.connect()
-            self.objects=self.client.get_objects_node()
-            self.subscription=self.client.create_subscription(self.interval, self.handler)
+            state=self.client.get_node(ua.NodeId(ua.ObjectIds.Server_ServerStatus_State)).get_value()
+            if state!=ua.ServerState.Running:
+                raise Exception("OPC server state is "+str(state))
             for key_memory in self.memory:
-                memory=self.get(key_memory)
-                for key_tag in memory:
-                    memory.get(key_tag).opcsubscribe()
-            self.connected=True
+                self.get(key_memory).readtime=self.lastkeepalive
+            self.responded()
         except Exception as e:
-            printexception(e,"Error connecting to OPC server")
+            printexception(e,"Lost connection to OPC server")
+            self.connected=False
+            self.client.disconnect_socket()
+            self.failed()
+
+    def opcsubscribe(self, tags:list):
+        ''' Suscripción de variables a sus nodos OPC.
+
+        Los nodos y tipos de dato se toman de la caché (ver cachefile) y sólo
+        se resuelven en el servidor las variables que no están en ella, o cuyo
+        nodo en caché ya no existe (BadNodeIdUnknown).
+        Se trabaja en grupos de batchsize variables, y los elementos
+        monitorizados de cada grupo se crean de una vez.
+        Las variables cuyo nodo no se encuentra se notifican y se omiten.
+
+        Args:
+        tags (Tag[]): Variables.
+
+        '''
+        for first in range(0,len(tags),self.batchsize):
+            batch=tags[first:first+self.batchsize]
+            cached=[]
+            for tag in batch:
+                if tag.address in self.nodecache:
+                    nodeid,tag.type=self.nodecache[tag.address]
+                    tag.node=self.client.get_node(ua.NodeId.from_string(nodeid))
+                    cached.append(tag)
+            resolved=self.resolve([tag for tag in batch if not tag.address in self.nodecache])
+            stale=[]
+            for tag,status in self.monitor(cached+resolved):
+                if tag in cached and status.value==ua.StatusCodes.BadNodeIdUnknown:
+                    del self.nodecache[tag.address]
+                    stale.append(tag)
+                else:
+                    print("Error subscribing tag "+str(tag.key)+" to OPC node: "+str(status))
+            for tag,status in self.monitor(self.resolve(stale)):
+                print("Error subscribing tag "+str(tag.key)+" to OPC node: "+str(status))
+        self.savecache()
+
+    def resolve(self, tags:list) -> list:
+        ''' Busca en el servidor los nodos y tipos de dato de las variables.
+
+        Las rutas se resuelven con una sola petición TranslateBrowsePathsToNodeIds,
+        y los tipos de dato se leen con una sola petición Read. Los resultados
+        se añaden a la caché.
+
+        Args:
+        tags (Tag[]): Variables.
+
+        Returns (Tag[]):
+        Variables cuyo nodo se ha encontrado.
+
+        '''
+        if len(tags)==0:
+            return []
+        paths=[]
+        for tag in tags:
+            path=ua.BrowsePath()
+            path.StartingNode=self.objects.nodeid
+            path.RelativePath=OPCPLC.relativepath(tag.address)
+            paths.append(path)
+        resolved=[]
+        for tag,result in zip(tags,self.client.uaclient.translate_browsepaths_to_nodeids(paths)):
+            if result.StatusCode.is_good() and len(result.Targets)>0:
+                tag.node=self.client.get_node(result.Targets[0].TargetId)
+                resolved.append(tag)
+            else:
+                print("OPC node not found for tag "+str(tag.key)+": "+str(result.StatusCode))
+        if len(resolved)==0:
+            return resolved
+        parameters=ua.ReadParameters()
+        for tag in resolved:
+            node=ua.ReadValueId()
+            node.NodeId=tag.node.nodeid
+            node.AttributeId=ua.AttributeIds.DataType
+            parameters.NodesToRead.append(node)
+        for tag,result in zip(resolved,self.client.uaclient.read(parameters)):
+            if result.StatusCode.is_good():
+                tag.type=int(result.Value.Value.Identifier)
+            self.nodecache[tag.address]=[tag.node.nodeid.to_string(),tag.type]
+        return resolved
+
+    def monitor(self, tags:list) -> list:
+        ''' Crea de una vez los elementos monitorizados de las variables.
+
+        Args:
+        tags (Tag[]): Variables con su nodo ya asignado.
+
+        Returns ([(Tag,StatusCode)]):
+        Variables que el servidor ha rechazado, con el motivo.
+
+        '''
+        if len(tags)==0:
+            return []
+        rejected=[]
+        handles=self.subscription.subscribe_data_change([tag.node for tag in tags])
+        for tag,handle in zip(tags,handles):
+            if isinstance(handle,ua.StatusCode):
+                rejected.append((tag,handle))
+            else:
+                self.tagbynodeid[tag.node.nodeid.Identifier]=tag
+        return rejected
+
+    def loadcache(self):
+        ''' Carga los nodos de este servidor.
+
+        La entrada se identifica por la dirección del servidor y su tabla de
+        espacios de nombres, de modo que si ésta cambia no se reutilizan nodos.
+        Si no cambia, en una reconexión se conservan los nodos ya resueltos.
+
+        '''
+        cachekey=" ".join([self.address+":"+str(self.port)]+self.client.get_namespace_array())
+        if cachekey==self.cachekey:
+            return
+        self.cachekey=cachekey
+        self.nodecache={}
+        if self.cachefile is None:
+            return
+        try:
+            if os.path.exists(self.cachefile):
+                with open(self.cachefile, encoding="utf8") as file:
+                    self.nodecache=json.load(file).get(self.cachekey,{})
+        except Exception as e:
+            printexception(e,"Error loading OPC node cache "+self.cachefile)
+
+    def savecache(self):
+        ''' Guarda en la caché los nodos de este servidor.
+
+        Se conservan las entradas del resto de servidores: el fichero se lee,
+        se combina y se escribe con la caché bloqueada (ver cachelock), y se
+        sustituye de una vez desde un fichero temporal propio, de modo que
+        nunca queda a medio escribir.
+
+        '''
+        if self.cachefile is None:
+            return
+        try:
+            with OPCPLC.cachelock:
+                cache={}
+                if os.path.exists(self.cachefile):
+                    with open(self.cachefile, encoding="utf8") as file:
+                        cache=json.load(file)
+                if cache.get(self.cachekey)==self.nodecache:
+                    return
+                cache[self.cachekey]=self.nodecache
+                handle,temporary=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cachefile)),suffix=".tmp")
+                try:
+                    with os.fdopen(handle, "w", encoding="utf8") as file:
+                        json.dump(cache, file)
+                    os.replace(temporary, self.cachefile)
+                except Exception:
+                    os.remove(temporary)
+                    raise
+        except Exception as e:
+            printexception(e,"Error saving OPC node cache "+self.cachefile)
+
+    @staticmethod
+    def relativepath(address:str):
+        ''' Ruta relativa OPC de una dirección de variable.
+
+        Args:
+        address (str): Dirección, con los nodos separados por '\\' (ver Tag).
+
+        Returns (RelativePath):
+        Ruta relativa desde el nodo de objetos.
+
+        '''
+        path=ua.RelativePath()
+        for name in address.split("\\"):
+            element=ua.RelativePathElement()
+            element.ReferenceTypeId=ua.TwoByteNodeId(ua.ObjectIds.HierarchicalReferences)
+            element.IsInverse=False
+            element.IncludeSubtypes=True
+            element.TargetName=ua.QualifiedName.from_string(name)
+            path.Elements.append(element)
+        return path
         
     def __tree(self, root, level:int=0):
         ''' Recursión para imprimir el árbol de nodos.
@@ -170,26 +447,118 @@ class OPCPLC(PLC):
         '''
         self.__tree(self.client.get_objects_node())
 
+    def __Supervising(plc):
+        ''' Supervisión de la conexión con el servidor.
+
+        Establece la conexión (ver open) y comprueba periódicamente que sigue
+        activa (ver check). Si se pierde, se reconecta y se vuelven a crear las
+        suscripciones; tras un intento fallido se espera según la política
+        de reintentos (ver PLC.backoff). Las escrituras encoladas (ver PLC.queue)
+        se ejecutan entre comprobaciones.
+
+        '''
+        while True:
+            plc.flush()
+            if plc.connected:
+                if time.monotonic()-plc.lastkeepalive>=plc.keepalive:
+                    plc.check()
+                plc.wait(max(plc.lastkeepalive+plc.keepalive-time.monotonic(),0.0))
+            elif plc.waittime()>0.0:
+                plc.wait(plc.waittime())
+            else:
+                print("Connecting to OPCPLC "+plc.address+":"+str(plc.port))
+                plc.attempt(plc.open)
+
 
     class Handler(object):
         ''' Manejador de los cambios en los valores de los nodos.
 
+        Las notificaciones no se procesan en la hebra del cliente OPC: se guardan
+        en una cola acotada, en la que un nuevo valor de un nodo ya encolado
+        sustituye al anterior, y una hebra aparte las aplica en lotes, cada uno
+        en una transacción seguida de un fin de ciclo de escaneo.
+
         Args:
         plc (PLC): Controlador.
+        queuesize (int): Máximo número de nodos con valores pendientes.
+
+        Attributes:
+        pending ({}): Último valor pendiente de cada nodo, en orden de llegada.
+        lock (Lock): Exclusión de la cola.
+        event (Event): Avisa a la hebra de que hay valores pendientes.
+        thread (Thread): Hebra que aplica los valores.
+        notifications (int): Notificaciones recibidas.
+        coalesced (int): Notificaciones que han sustituido a un valor pendiente del mismo nodo.
+        overflows (int): Notificaciones descartadas por estar llena la cola.
 
         '''
         
-        def __init__(self,plc):
+        def __init__(self, plc, queuesize:int=100000):
             self.plc=plc
+            self.queuesize=queuesize
+            self.pending={}
+            self.lock=Lock()
+            self.event=Event()
+            self.notifications=0
+            self.coalesced=0
+            self.overflows=0
+            self.thread=Thread(target=self.__Dispatching, args=(), daemon=True)
+            self.thread.start()
 
         def datachange_notification(self, node, val, data):
             ''' Método llamado cuando cambia el valor de un nodo.
 
+            Encola el valor para la hebra que los aplica.
+
             Args:
             node: Nodo.
             val: Valor.
             data: Datos.
 
             '''
-            self.plc.tagbynodeid[node.nodeid.Identifier].update(val)
+            key=node.nodeid.Identifier
+            with self.lock:
+                self.notifications+=1
+                if key in self.pending:
+                    self.coalesced+=1
+                elif len(self.pending)>=self.queuesize:
+                    self.overflows+=1
+                    return
+                self.pending[key]=val
+            self.event.set()
+
+        def __Dispatching(handler):
+            ''' Aplicación de los valores encolados a las variables.
+
+            '''
+            plc=handler.plc
+            while True:
+                handler.event.wait()
+                handler.event.clear()
+                with handler.lock:
+                    pending=handler.pending
+                    handler.pending={}
+                plc.begin()
+                try:
+                    for key,value in pending.items():
+                        tag=plc.tagbynodeid.get(key)
+                        if not tag is None:
+                            tag.update(value)
+                except Exception as e:
+                    printexception(e,"Error updating OPC tags")
+                finally:
+                    plc.commit()
+                plc.endscan()
+
+        def status_change_notification(self, status):
+            ''' Método llamado cuando cambia el estado de la suscripción.
+
+            Adelanta la comprobación de la conexión.
+
+            Args:
+            status: Nuevo estado.
+
+            '''
+            self.plc.lastkeepalive=0.0
+            self.plc.wake()
             
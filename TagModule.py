@@ -7,9 +7,13 @@ __date__="2016-02-14"
 __version__="1.3"
 
 import sys
-from threading import Thread
+import asyncio
+from threading import Thread, Lock, RLock, Event, local
 import time
 import re
+import ast
+import heapq
+import random
 from datetime import datetime
 from sqlalchemy import *
 
@@ -24,6 +28,41 @@ class PLC(object):
     class Memory(object):
         class Tag(object):pass
 
+class Backoff(object):
+    ''' Política de reintentos de conexión con espera exponencial.
+
+    La espera se multiplica por factor en cada intento fallido, hasta maximum,
+    y se le aplica una variación aleatoria para que no se sincronicen los
+    reintentos de muchos controladores.
+
+    Args:
+    initial (float): Segundos de espera tras el primer fallo.
+    maximum (float): Segundos máximos de espera.
+    factor (float): Factor de crecimiento de la espera.
+    jitter (float): Variación aleatoria relativa (0.1 es un ±10%).
+
+    '''
+
+    def __init__(self, initial:float=1.0, maximum:float=60.0, factor:float=2.0, jitter:float=0.1):
+        self.initial=initial
+        self.maximum=maximum
+        self.factor=factor
+        self.jitter=jitter
+
+    def delay(self, attempts:int) -> float:
+        ''' Devuelve la espera antes del siguiente intento.
+
+        Args:
+        attempts (int): Intentos fallidos consecutivos.
+
+        Returns (float):
+        Segundos de espera.
+
+        '''
+        delay=min(self.maximum, self.initial*self.factor**max(attempts-1,0))
+        return delay*(1.0+random.uniform(-self.jitter,self.jitter))
+
+
 class PLC(object):
     ''' Representación de un controlador.
 
@@ -32,8 +71,32 @@ class PLC(object):
     Attributes:
     memory (Memory{}): Áreas de memoria.
     connected (bool): Estado de la conexión.
+    state (type): Estado de la conexión (DISCONNECTED, CONNECTING, CONNECTED o BACKOFF).
+    backoff (Backoff): Política de reintentos de conexión.
+    attempts (int): Intentos fallidos consecutivos, de conexión o de lectura. Sólo se
+        reinicia cuando el controlador responde (ver responded), no al conectar.
+    retrytime (float): Momento (time.monotonic) a partir del cual puede reintentarse la conexión.
+    writes ({Tag:valor}): Escrituras pendientes (sólo el último valor de cada variable).
+    writecallback ([]): Funciones a las que se comunica el resultado de las escrituras pendientes.
+    wakeup (Event): Despierta a la hebra de escaneo cuando hay escrituras pendientes.
+    polling (bool): El driver tiene hebra de escaneo que ejecuta las escrituras (ver flush).
+        Si no, se crea una hebra de escritura con la primera escritura encolada.
+    writer (Thread): Hebra de escritura (None si no se usa).
+    scansubscriptor (Subscriptor[]): Objetos avisados al final de cada ciclo de escaneo.
+    transaction (int): Nivel de anidamiento de transacciones abiertas.
+    changed (Tag{}): Variables modificadas en la transacción en curso, en orden.
+    lock (Lock): Protege las variables modificadas de accesos concurrentes.
+    maxage (float): Política de frescura de Tag.get: segundos que puede tener el valor
+        en caché de una memoria antes de leerlo del origen. None (por defecto) para
+        usar siempre la caché, que mantiene al día la hebra de escaneo.
+    sourcereads (int): Lecturas del origen hechas por Tag.get.
+    cachedreads (int): Lecturas del origen evitadas por Tag.get al usar la caché.
+    dispatching (local): Controlador cuya transacción se está confirmando en cada hebra
+        (ver commit), al que se anotan los cambios de las expresiones y alarmas.
 
     '''
+
+    dispatching=local()
     
     class Memory(object):
         ''' Representacióne un área de memoria.
@@ -44,6 +107,8 @@ class PLC(object):
         Attributes:
         tag (tag{}): Diccionario de variables ordenadas por nombre.
         tagbyaddress (tag{}): Diccionario de variables ordenadas por dirección.
+        readtime (float): Momento (time.monotonic) de la última lectura del origen.
+            Lo actualizan los drivers (ver PLC.maxage).
 
         '''
 
@@ -59,8 +124,19 @@ class PLC(object):
             Attributes:
             value: Valor.
             subscriptor (Subcriptor[]): Objetos suscritos a los cambios.
+            deadband (float): Cambio absoluto mínimo para propagar un nuevo valor (None si no se usa).
+            deadbandpercent (float): Cambio mínimo, en porcentaje del último valor propagado (None si no se usa).
+            mininterval (float): Segundos mínimos entre dos cambios propagados (None si no se usa).
+            lastupdate (float): Momento (time.monotonic) del último cambio propagado.
+
+            Para reducir la memoria en bases de datos con muchas variables, los atributos
+            se declaran en __slots__ (las clases derivadas deben declarar los suyos),
+            y la lista de suscriptores sólo se crea con la primera suscripción.
             
             '''
+
+            __slots__=("memory","key","address","description","value","subscriptor",
+                       "deadband","deadbandpercent","mininterval","lastupdate")
             
             def __init__(self, memory:PLC.Memory=None, key:str=None, description:str="", address=None):
                 self.memory=memory
@@ -68,23 +144,85 @@ class PLC(object):
                 self.address=address
                 self.description=description
                 self.value=None
-                self.subscriptor=[]
+                self.subscriptor=()
+                self.deadband=None
+                self.deadbandpercent=None
+                self.mininterval=None
+                self.lastupdate=0.0
 
             def update(self, value):
                 ''' Modifica el valor de una variable.
 
                 En clases derivadas de Tag, debe redefinirse set, y después llamar a update.
+                Si el controlador tiene una transacción abierta (ver PLC.begin),
+                el aviso a los suscriptores se aplaza hasta que se confirme.
+                Los cambios que no superan los filtros (ver accept) se descartan
+                y la variable conserva el último valor propagado.
 
                 Args:
                 value: Nuevo valor de la variable.
 
                 '''
                 if not self.value==value:
+                    if (self.deadband or self.deadbandpercent or self.mininterval) and not self.accept(value):
+                        return
                     self.value=value
-                    for subscriptor in self.subscriptor:
-                        subscriptor.update(self)
+                    self.publish()
+
+            def publish(self):
+                ''' Avisa del nuevo valor, o lo anota si hay una transacción abierta.
+
+                Las variables sin memoria (expresiones y alarmas) usan la transacción
+                que se está confirmando en la hebra (ver PLC.commit), de modo que sus
+                cambios llegan a los suscriptores en el mismo lote que los de las
+                variables de las que dependen.
+
+                '''
+                plc=getattr(PLC.dispatching,"plc",None) if self.memory is None else self.memory.plc
+                if plc is not None and plc.transaction>0:
+                    plc.change(self)
+                else:
+                    self.notify()
+
+            def accept(self, value) -> bool:
+                ''' Comprueba si un nuevo valor supera la banda muerta y el intervalo mínimo.
+
+                La banda muerta sólo se aplica a valores numéricos. El primer valor
+                siempre se acepta.
+
+                Args:
+                value: Nuevo valor de la variable.
+
+                Returns (bool):
+                Verdadero si el cambio debe propagarse.
+
+                '''
+                if self.value is None:
+                    self.lastupdate=time.monotonic()
+                    return True
+                try:
+                    change=abs(value-self.value)
+                    if self.deadband and change<=self.deadband:
+                        return False
+                    if self.deadbandpercent and change<=abs(self.value)*self.deadbandpercent/100.0:
+                        return False
+                except TypeError:
+                    pass
+                if self.mininterval:
+                    now=time.monotonic()
+                    if now-self.lastupdate<self.mininterval:
+                        return False
+                    self.lastupdate=now
+                return True
+
+            def notify(self):
+                ''' Avisa a los objetos suscritos de que ha cambiado el valor.
+
+                '''
+                for subscriptor in self.subscriptor:
+                    subscriptor.update(self)
 
-            def set(self,value):
+            def set(self,value) -> bool:
                 ''' Modifica o asigna el valor de una variable.
 
                 Puede redefinirse en clases derivadas.
@@ -92,15 +230,90 @@ class PLC(object):
                 Args:
                 value: Nuevo valor de la variable.
 
+                Returns (bool):
+                Verdadero si se ha escrito el valor.
+
                 '''
-                self.update(self,value)
+                self.update(value)
+                return True
 
             def get(self):
                 ''' Devuelve el valor de una variable.
 
+                Es el valor en caché, que mantiene al día la hebra de escaneo del driver,
+                por lo que no accede al controlador. Sólo si el controlador tiene
+                política de frescura (ver PLC.maxage) y la variable no se ha leído
+                en ese tiempo (ver lastread), se lee antes del origen (ver refresh).
+                Desde un bucle asyncio (por ejemplo, el del servidor de websockets)
+                no se espera a esa lectura: se pide (ver request) y se devuelve la caché.
+
+                '''
+                if self.memory is None:
+                    return self.value
+                plc=self.memory.plc
+                if not plc.maxage is None and plc.connected and time.monotonic()-self.lastread()>plc.maxage:
+                    if not PLC.onloop():
+                        plc.sourcereads+=1
+                        return self.refresh()
+                    self.request()
+                plc.cachedreads+=1
+                return self.value
+
+            def lastread(self) -> float:
+                ''' Momento (time.monotonic) de la última lectura del origen de la variable.
+
+                Por defecto, el de su memoria (ver Memory.readtime). Los drivers
+                que leen la memoria por partes pueden redefinirlo.
+
+                Returns (float):
+                Momento de la lectura.
+
+                '''
+                return self.memory.readtime
+
+            def refresh(self):
+                ''' Lee el valor de una variable del origen y lo actualiza.
+
+                Debe definirse en la clase derivada. Por defecto devuelve el valor en caché.
+
+                Returns:
+                Valor de la variable.
+
                 '''
                 return self.value
 
+            def request(self):
+                ''' Pide que la variable se lea del origen cuanto antes, sin esperar a la lectura.
+
+                Puede redefinirse en clases derivadas. Por defecto no hace nada, y el valor
+                se actualiza en el siguiente ciclo de escaneo.
+
+                '''
+                pass
+
+            def configure(self, deadband:str=None, deadbandpercent:str=None, mininterval:str=None, **options):
+                ''' Configura opciones adicionales de la variable.
+
+                Las opciones corresponden a las columnas adicionales del fichero
+                de variables (ver Ensemble.import_tags). Las clases derivadas
+                tratan sus propias opciones y pasan el resto a la clase base.
+
+                Args:
+                deadband (str): Banda muerta absoluta.
+                deadbandpercent (str): Banda muerta en porcentaje del último valor.
+                mininterval (str): Segundos mínimos entre cambios propagados.
+                options ({str:str}): Resto de opciones (no se admite ninguna más).
+
+                '''
+                if deadband:
+                    self.deadband=float(deadband)
+                if deadbandpercent:
+                    self.deadbandpercent=float(deadbandpercent)
+                if mininterval:
+                    self.mininterval=float(mininterval)
+                for option in options:
+                    raise Exception("Unknown option "+option+" for tag "+str(self.key))
+
             def subscribe(self, subscriptor: Subscriptor):
                 ''' Suscribe un objeto a los cambios del valor de la variable.
 
@@ -111,6 +324,8 @@ class PLC(object):
                 subscriptor: Objeto suscrito. 
 
                 '''
+                if len(self.subscriptor)==0:
+                    self.subscriptor=[]
                 self.subscriptor.append(subscriptor)
 
         
@@ -118,6 +333,7 @@ class PLC(object):
             self.plc=plc
             self.tag={}
             self.tagbyaddress={}
+            self.readtime=0.0
 
         def create(self, tag_key, description:str="", address=None) -> Tag:
             ''' Crea una variable dentro de la memoria.
@@ -173,9 +389,37 @@ class PLC(object):
             return iter(self.tag)
 
 
+    class DISCONNECTED:
+        """Estado sin conexión."""
+        pass
+    class CONNECTING:
+        """Estado de conexión en curso."""
+        pass
+    class CONNECTED:
+        """Estado conectado."""
+        pass
+    class BACKOFF:
+        """Estado de espera tras un intento de conexión fallido."""
+        pass
+
     def __init__(self):
         self.memory={}
-        self.connected=False
+        self.state=PLC.DISCONNECTED
+        self.backoff=Backoff()
+        self.attempts=0
+        self.retrytime=0.0
+        self.scansubscriptor=[]
+        self.transaction=0
+        self.changed={}
+        self.lock=Lock()
+        self.writes={}
+        self.writecallback=[]
+        self.wakeup=Event()
+        self.polling=False
+        self.writer=None
+        self.maxage=None
+        self.sourcereads=0
+        self.cachedreads=0
 
     def create(self,memory_key) -> Memory:
         ''' Crea una memoria en el controlador.
@@ -228,6 +472,295 @@ class PLC(object):
     def __iter__(self):
         return iter(self.memory)
     
+    @property
+    def connected(self) -> bool:
+        ''' Estado de la conexión.
+
+        Asignar verdadero o falso equivale a pasar a los estados CONNECTED o DISCONNECTED.
+
+        '''
+        return self.state==PLC.CONNECTED
+
+    @connected.setter
+    def connected(self, connected:bool):
+        if connected:
+            self.succeeded()
+        else:
+            self.state=PLC.DISCONNECTED
+
+    def succeeded(self):
+        ''' Anota un intento de conexión con éxito.
+
+        No reinicia los intentos fallidos: que se pueda abrir la conexión no implica
+        que el controlador responda (p. ej. una pasarela con el esclavo caído).
+
+        '''
+        self.state=PLC.CONNECTED
+
+    def responded(self):
+        ''' Anota una lectura correcta del controlador y reinicia los intentos fallidos.
+
+        Deben llamarlo los drivers tras cada lectura con éxito.
+
+        '''
+        self.attempts=0
+
+    def failed(self) -> float:
+        ''' Anota un intento de conexión o una lectura fallidos y programa el siguiente intento.
+
+        Returns (float):
+        Segundos de espera hasta el siguiente intento.
+
+        '''
+        self.attempts+=1
+        delay=self.backoff.delay(self.attempts)
+        self.retrytime=time.monotonic()+delay
+        self.state=PLC.BACKOFF
+        return delay
+
+    def waittime(self) -> float:
+        ''' Segundos que faltan para poder reintentar la conexión.
+
+        Returns (float):
+        Segundos de espera (0 si puede intentarse ya).
+
+        '''
+        return max(self.retrytime-time.monotonic(),0.0)
+
+    def attempt(self, connect) -> bool:
+        ''' Intenta establecer la conexión y actualiza el estado.
+
+        Args:
+        connect: Función sin argumentos que conecta y devuelve verdadero si lo consigue.
+
+        Returns (bool):
+        Verdadero si se ha conectado.
+
+        '''
+        self.state=PLC.CONNECTING
+        try:
+            connected=connect()
+        except Exception as e:
+            printexception(e,"Error connecting to PLC")
+            connected=False
+        if connected:
+            self.succeeded()
+        else:
+            self.failed()
+        return connected
+
+    @staticmethod
+    def onloop() -> bool:
+        ''' Indica si la hebra actual está ejecutando un bucle asyncio, que no debe bloquearse.
+
+        Returns (bool):
+        Verdadero si hay un bucle en marcha en la hebra.
+
+        '''
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+
+    def subscribe_scan(self, subscriptor: Subscriptor):
+        ''' Suscribe un objeto al final de cada ciclo de escaneo.
+
+        El objeto que se suscribe debe tener un método endscan,
+        al que se llama con el controlador cuando termina una lectura completa.
+
+        Args:
+        subscriptor: Objeto suscrito.
+
+        '''
+        if not subscriptor in self.scansubscriptor:
+            self.scansubscriptor.append(subscriptor)
+
+    def endscan(self):
+        ''' Avisa a los objetos suscritos de que ha terminado un ciclo de escaneo.
+
+        Deben llamarlo los drivers después de cada lectura.
+
+        '''
+        for subscriptor in self.scansubscriptor:
+            subscriptor.endscan(self)
+
+    def write(self, values:dict) -> bool:
+        ''' Escritura de varias variables del controlador.
+
+        Por defecto, se escriben una a una con set. Los drivers pueden
+        redefinirla para agrupar las escrituras.
+
+        Args:
+        values ({Tag:valor}): Valores por variable.
+
+        Returns (bool):
+        Verdadero si se han escrito todas las variables.
+
+        '''
+        result=True
+        self.begin()
+        try:
+            for tag,value in values.items():
+                if not tag.set(value):
+                    result=False
+            return result
+        except Exception as e:
+            printexception(e,"Error writing to PLC")
+            return False
+        finally:
+            self.commit()
+
+    def queue(self, values:dict, callback=None):
+        ''' Encola la escritura de varias variables sin esperar a que se realice.
+
+        Si una variable ya tenía una escritura pendiente, sólo se conserva el último valor.
+        Las escrituras las ejecuta la hebra de escaneo del driver (o una hebra de escritura).
+
+        Args:
+        values ({Tag:valor}): Valores por variable.
+        callback: Función a la que se llama con el resultado (bool) de la escritura.
+
+        '''
+        with self.lock:
+            for tag,value in values.items():
+                self.writes[tag]=value
+            if not callback is None:
+                self.writecallback.append(callback)
+        self.wake()
+
+    def wake(self):
+        ''' Avisa de que hay escrituras pendientes.
+
+        '''
+        if not self.polling and self.writer is None:
+            self.writer=Thread(target=self.__Writing, args=(), daemon=True)
+            self.writer.start()
+        self.wakeup.set()
+
+    def wait(self, seconds:float):
+        ''' Espera el tiempo indicado, o hasta que haya escrituras pendientes.
+
+        Args:
+        seconds (float): Segundos máximos de espera.
+
+        '''
+        if self.wakeup.wait(seconds):
+            self.wakeup.clear()
+
+    def pending(self) -> tuple:
+        ''' Extrae las escrituras pendientes.
+
+        Returns (({Tag:valor},[])):
+        Escrituras y funciones a las que comunicar el resultado.
+
+        '''
+        with self.lock:
+            writes, callbacks=self.writes, self.writecallback
+            self.writes={}
+            self.writecallback=[]
+        return writes, callbacks
+
+    def written(self, callbacks:list, result:bool):
+        ''' Comunica el resultado de unas escrituras.
+
+        Args:
+        callbacks ([]): Funciones a las que se comunica.
+        result (bool): Resultado.
+
+        '''
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                printexception(e,"Error reporting write result")
+
+    def flush(self) -> bool:
+        ''' Ejecuta las escrituras pendientes (ver write) y comunica el resultado.
+
+        Returns (bool):
+        Verdadero si no había escrituras o si se han realizado todas.
+
+        '''
+        writes, callbacks=self.pending()
+        if len(writes)==0:
+            self.written(callbacks, True)
+            return True
+        result=self.write(writes)
+        self.written(callbacks, result)
+        return result
+
+    def __Writing(plc):
+        ''' Ejecución de las escrituras encoladas en drivers sin hebra de escaneo.
+
+        '''
+        while True:
+            plc.wakeup.wait()
+            plc.wakeup.clear()
+            plc.flush()
+
+    def begin(self):
+        ''' Abre una transacción.
+
+        Mientras esté abierta, los cambios de valor de las variables del controlador
+        se acumulan en lugar de avisar a los suscriptores uno a uno.
+        Las transacciones pueden anidarse; se confirman al cerrar la más externa.
+
+        '''
+        with self.lock:
+            self.transaction+=1
+
+    def change(self, tag:PLC.Memory.Tag):
+        ''' Anota una variable modificada durante la transacción en curso.
+
+        Args:
+        tag (Tag): Variable cuyo valor ha cambiado.
+
+        '''
+        with self.lock:
+            self.changed[tag]=None
+
+    def commit(self):
+        ''' Cierra una transacción y avisa a los suscriptores.
+
+        Primero se avisa a los suscriptores que calculan valores derivados
+        (ver Subscriptor.derives) con la transacción aún abierta, de modo que
+        los cambios de expresiones y alarmas se anotan también, y se repite
+        mientras haya cambios nuevos. Después cada uno de los demás suscriptores
+        recibe una sola llamada a update_batch con la lista de variables,
+        propias o derivadas, a las que está suscrito y que han cambiado.
+
+        '''
+        with self.lock:
+            if self.transaction>1 or len(self.changed)==0:
+                self.transaction-=1
+                return
+        previous=getattr(PLC.dispatching,"plc",None)
+        PLC.dispatching.plc=self
+        batch={}
+        try:
+            while True:
+                with self.lock:
+                    changed=self.changed
+                    self.changed={}
+                if len(changed)==0:
+                    break
+                derived={}
+                for tag in changed:
+                    for subscriptor in tag.subscriptor:
+                        if getattr(subscriptor,"derives",False):
+                            derived.setdefault(subscriptor,[]).append(tag)
+                        else:
+                            batch.setdefault(subscriptor,{})[tag]=None
+                for subscriptor,tags in derived.items():
+                    subscriptor.update_batch(tags)
+        finally:
+            PLC.dispatching.plc=previous
+            with self.lock:
+                self.transaction-=1
+        for subscriptor,tags in batch.items():
+            subscriptor.update_batch(list(tags))
+
     def connect(self):
         ''' Establece conexión con el controlador.
 
@@ -245,8 +778,14 @@ class PLC(object):
 
 class Subscriptor(object):
     ''' Objeto que puede suscribirse a los cambios de valor de una variable.
+
+    Attributes:
+    derives (bool): Calcula valores derivados (expresiones y alarmas), por lo que
+        al confirmar una transacción se le avisa antes que al resto (ver PLC.commit).
  
     '''
+
+    derives=False
     
     def update(self, tag:PLC.Memory.Tag):
         ''' Método que se llama cuando cambia el valor de una variable.
@@ -259,6 +798,18 @@ class Subscriptor(object):
         '''        
         pass
 
+    def update_batch(self, tags:list):
+        ''' Método que se llama al confirmar una transacción con las variables que han cambiado.
+
+        Por defecto, llama a update con cada una de ellas.
+
+        Args:
+        tags (Tag[]): Variables cuyo valor ha cambiado.
+
+        '''
+        for tag in tags:
+            self.update(tag)
+
 
 class Expression(Subscriptor, PLC.Memory.Tag):
     ''' Expresión evaluable.
@@ -266,7 +817,8 @@ class Expression(Subscriptor, PLC.Memory.Tag):
     La expresión se instancia pasándole el diccionario de variables,
     del cual puede formar parte. Una vez el diccionario está completo,
     se debe llamar al método analyze, que realiza las suscripciones.
-    ¡La clase no comprueba referencias circulares!
+    La clase por sí sola no comprueba referencias circulares; para ello
+    las expresiones deben evaluarse a través de un ExpressionGraph.
     Las operaciones permitidas son: suma, resta, multiplicación, división,
     igualdad, superioridad e inferioridad. Para anidamientos se usan
     paréntesis.
@@ -280,12 +832,21 @@ class Expression(Subscriptor, PLC.Memory.Tag):
     key (str): Nombre.
     value: Valor de la expresión.
     subscriptor (Subcriptor[]): Objetos suscritos a los cambios.
+    usedtags (Tag[]): Variables que aparecen en la definición, en orden.
+    allowed (type[]): Nodos sintácticos permitidos en una definición.
 
     Internal:
-    __serialization (str[]): Expresión serializada.
+    __inputs (Tag[]): Variables distintas, en el orden de los argumentos de la función.
+    __function: Función compilada a partir de la definición.
     
     '''
 
+    derives=True
+
+    allowed=(ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load, ast.Constant,
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd,
+        ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
     def __init__(self, key: str, definition:str, tags: dict, description:str=None):
         self.definition=definition
         self.tags=tags
@@ -294,47 +855,98 @@ class Expression(Subscriptor, PLC.Memory.Tag):
         else:
             self.description=description
         self.usedtags=[]
-        self.__serialization=[]
+        self.__inputs=[]
+        self.__function=None
         super().__init__(None, key, description)
-    
-    def analyze(self):
+
+    def translate(self) -> str:
+        ''' Traduce la definición a código Python y comprueba que sea segura.
+
+        Cada variable se sustituye por un argumento posicional (_0, _1...),
+        de modo que el resultado puede compilarse como una función lambda.
+        Sólo se admiten números, variables, operaciones aritméticas y comparaciones.
+
+        Returns (str):
+        Código fuente de la función lambda.
+
+        '''
+        self.usedtags=[]
+        self.__inputs=[]
+        source=""
+        for element in re.split("([ +\-*/()=<>!])",self.definition):
+            if len(element)>0 and element[0].isalpha():    # Si un elemento empieza por un carácter se interpreta como variable.
+                tag=self.tags[element]
+                self.usedtags.append(tag)
+                if not tag in self.__inputs:
+                    self.__inputs.append(tag)
+                source=source+"_"+str(self.__inputs.index(tag))
+            else:
+                source=source+element
+        source=re.sub("(?<![=<>!])=(?!=)","==",source)   # El operador de igualdad puede escribirse con un solo '='.
+        tree=ast.parse(source.strip(),mode="eval")
+        if len([node for node in ast.walk(tree) if isinstance(node,ast.Name)])!=len(self.usedtags):
+            raise SyntaxError("Unknown name in expression")
+        for node in ast.walk(tree):
+            if not isinstance(node,Expression.allowed):
+                raise SyntaxError("Element not allowed: "+type(node).__name__)
+            if isinstance(node,ast.Constant) and not type(node.value) in (int,float):
+                raise SyntaxError("Constant not allowed: "+repr(node.value))
+        arguments=",".join(["_"+str(i) for i in range(len(self.__inputs))])
+        return "lambda "+arguments+": "+source.strip()
+
+    def analyze(self, subscribe:bool=True):
         ''' Analiza la definición de la expresión y realiza suscripciones.
 
+        La definición se compila una única vez; después, update
+        sólo tiene que evaluar la función resultante.
         Debe llamarse cuando el diccionario de variables esté completo.
 
+        Args:
+        subscribe (bool): Suscribe la expresión a sus variables. Es falso cuando
+            la evaluación la dirige un grafo de dependencias (ver ExpressionGraph).
+
         '''
-        elements=re.split("[ +\-*/()=<>]",self.definition)
         try:
-            for element in elements:
-                if len(element)>0 and element[0].isalpha():    # Si un elemento empieza por un carácter se interpreta como variable.
-                    self.tags[element].subscribe(self)
-                    self.usedtags.append(self.tags[element])
-            self.__serialization=re.split("( |\+|\-|\*|/|\(|\<|\>|\))",self.definition)
-        except:
+            self.__function=eval(compile(self.translate(),"<"+str(self.key)+">","eval"),{"__builtins__":{}})
+        except Exception:
             raise Exception("Bad expression: "+self.definition)
+        if subscribe:
+            for tag in self.__inputs:
+                tag.subscribe(self)
 
     def update(self, tag):
         ''' Evaluación de la expresión.
 
+        Si alguna de las variables no tiene valor, la expresión no se evalúa.
+        Si el valor cambia, se avisa a los objetos suscritos a la expresión.
+
         Args:
         tag [Tag]: Variable cuyo valor ha cambiado.
 
-        '''   
-        evaluation=""
+        '''
         try:
-            for element in self.__serialization:
-                if len(element)>0 and element[0].isalpha():
-                    value=self.tags[element].get()
-                    if value==None:
-                        return None
-                    else:
-                        evaluation=evaluation+str(self.tags[element].get()) # Reemplaza cada variable por su valor
-                else:
-                    evaluation=evaluation+element
-            self.value=eval(evaluation)
+            values=[]
+            for used in self.__inputs:
+                value=used.get()
+                if value is None:
+                    return None
+                values.append(value)
+            value=self.__function(*values)
+            if not self.value==value:
+                self.value=value
+                self.publish()
         except Exception as e:
             printexception(e,"Error evaluating expresion "+self.definition)
-            
+
+    def update_batch(self, tags:list):
+        ''' Evaluación de la expresión una sola vez para todas las variables que han cambiado.
+
+        Args:
+        tags (Tag[]): Variables cuyo valor ha cambiado.
+
+        '''
+        self.update(tags[-1])
+
 
 class Alarm(Expression):
     ''' Alarma.
@@ -365,6 +977,15 @@ class Alarm(Expression):
         '''
         oldvalue=self.value
         super().update(tag)
+        self.report(oldvalue)
+
+    def report(self, oldvalue):
+        ''' Escribe en las salidas de sus grupos si la alarma se ha activado o desactivado.
+
+        Args:
+        oldvalue: Valor de la alarma antes de la última evaluación.
+
+        '''
         if self.value and not oldvalue:
             for alarmgroup in self.alarmgroup:
                 for output in alarmgroup.output:
@@ -414,6 +1035,113 @@ class AlarmGroup(object):
     def __iter__():
         return alarm.iter()
 
+class ExpressionGraph(Subscriptor):
+    ''' Grafo de dependencias entre expresiones.
+
+    Ordena topológicamente las expresiones (y alarmas) según las variables
+    que usan, y rechaza las referencias circulares. El grafo se suscribe
+    a las variables de las que dependen las expresiones, y cada cambio
+    (o lote de cambios de una transacción) provoca una única ola de
+    propagación en la que cada expresión afectada se evalúa una sola vez,
+    después de todas las expresiones de las que depende.
+
+    Args:
+    expressions (Expression[]): Expresiones que forman el grafo.
+
+    Attributes:
+    order (Expression[]): Expresiones en orden topológico.
+    rank (int{}): Posición de cada expresión en el orden.
+    dependent (Expression[]{}): Expresiones que dependen de cada variable o expresión.
+    lock (RLock): Impide olas de propagación simultáneas desde distintas hebras.
+    evaluations (int): Número de evaluaciones de expresiones realizadas.
+
+    '''
+
+    derives=True
+
+    def __init__(self, expressions:list):
+        self.order=[]
+        self.rank={}
+        self.dependent={}
+        self.lock=RLock()
+        self.evaluations=0
+        nodes=list(dict.fromkeys(expressions))
+        pending={}
+        for node in nodes:
+            node.analyze(False)
+            pending[node]=0
+        for node in nodes:
+            for tag in set(node.usedtags):
+                self.dependent.setdefault(tag,[]).append(node)
+                if tag in pending:
+                    pending[node]+=1
+        ready=[node for node in nodes if pending[node]==0]
+        while len(ready)>0:
+            node=ready.pop(0)
+            self.rank[node]=len(self.order)
+            self.order.append(node)
+            for dependent in self.dependent.get(node,[]):
+                pending[dependent]-=1
+                if pending[dependent]==0:
+                    ready.append(dependent)
+        if len(self.order)<len(nodes):
+            circular=[str(node.key) for node in nodes if not node in self.rank]
+            raise Exception("Circular reference between expressions: "+", ".join(circular))
+        for tag in self.dependent:
+            if not tag in self.rank:
+                tag.subscribe(self)
+
+    def update(self, tag:PLC.Memory.Tag):
+        ''' Propaga el cambio de una variable.
+
+        Args:
+        tag (Tag): Variable cuyo valor ha cambiado.
+
+        '''
+        self.propagate([tag])
+
+    def update_batch(self, tags:list):
+        ''' Propaga, en una sola ola, los cambios de una transacción.
+
+        Args:
+        tags (Tag[]): Variables cuyo valor ha cambiado.
+
+        '''
+        self.propagate(tags)
+
+    def propagate(self, tags:list):
+        ''' Evalúa en orden topológico las expresiones afectadas por los cambios.
+
+        Una expresión sólo se marca para evaluar si cambia alguna de sus entradas,
+        y se evalúa como mucho una vez por ola.
+
+        Args:
+        tags (Tag[]): Variables cuyo valor ha cambiado.
+
+        '''
+        with self.lock:
+            dirty=[]
+            queued=set()
+            for tag in tags:
+                for node in self.dependent.get(tag,[]):
+                    if not node in queued:
+                        queued.add(node)
+                        heapq.heappush(dirty,self.rank[node])
+            while len(dirty)>0:
+                node=self.order[heapq.heappop(dirty)]
+                oldvalue=node.value
+                node.update(None)
+                self.evaluations+=1
+                if not node.value==oldvalue:
+                    for dependent in self.dependent.get(node,[]):
+                        if not dependent in queued:
+                            queued.add(dependent)
+                            heapq.heappush(dirty,self.rank[dependent])
+
+    def __iter__(self):
+        return iter(self.order)
+
+
 def printexception(e:Exception,text:str):
     exc_type, exc_value, exc_traceback = sys.exc_info()
     print(">==========")
@@ -33,7 +33,13 @@ class WSHandle(WebSocketServerProtocol, Output):
         devuelve sus valores (action=values, y tags contiene la lista
         de variables y valores). También se suscribe a grupos de alarmas,
         definidos en la lista alarmgroups.
-        Si action=change, modifica el valor de la variable tag.
+        Si action=trend, devuelve los datos de las variables tags entre from y to,
+        reducidos a unos points puntos (normalmente, el ancho en píxeles del gráfico).
+        Si action=change, modifica el valor de la variable tag, o, si se
+        incluye tags (diccionario de variables y valores), el de todas ellas
+        agrupando las escrituras por controlador. Las escrituras se encolan
+        sin bloquear el websocket, y su resultado se envía después
+        (action=written, tags con la lista de variables y result).
         La respuesta se envía en JSON.
 
         Args:
@@ -74,7 +80,10 @@ class WSHandle(WebSocketServerProtocol, Output):
 
                 # Modificación de variables
                 elif message["action"]=="change":
-                    self.ensemble.tag[message["tag"]].set(message["value"])
+                    if "tags" in message:
+                        self.ensemble.queue(message["tags"], self.written)
+                    else:
+                        self.ensemble.queue({message["tag"]:message["value"]}, self.written)
 
                 # Inserción en formulario (tabla)
                 elif message["action"]=="set_row":
@@ -89,11 +98,12 @@ class WSHandle(WebSocketServerProtocol, Output):
                     datefrom=message["from"]
                     dateto=message["to"]
                     tags=message["tags"]
+                    points=int(message["points"]) if "points" in message else None
                     response={"action":"trend","trend":trend,"from":datefrom,"to":dateto,"tags":[]}
                     for tag_key in tags:
                         tag=self.ensemble.tag[tag_key]
                         message_tag={"label":tag_key+": "+tag.description}
-                        message_tag["data"]=tag.get_data(int(datefrom),int(dateto))
+                        message_tag["data"]=tag.get_data(int(datefrom),int(dateto),points)
                         response["tags"].append(message_tag)
                     payload = json.dumps(response).encode('utf8')
                     self.sendMessage(payload, isBinary = False)
@@ -118,6 +128,39 @@ class WSHandle(WebSocketServerProtocol, Output):
         payload = json.dumps(response).encode('utf8')
         self.sendMessage(payload, isBinary = False)
 
+    def update_batch(self, tags:list):
+        ''' Envía por el websocket, en un solo mensaje, las variables que han cambiado en un escaneo.
+
+        La respuesta se envía en JSON (action=values, y tags contiene la lista
+        de variables y valores).
+
+        Args:
+        tags (Tag[]): Variables cuyo valor ha cambiado.
+
+        '''
+        tagvalues=self.transform_read([tag.key for tag in tags],False)
+        response={"action":"values",
+                  "tags":tagvalues}
+        payload = json.dumps(response).encode('utf8')
+        self.sendMessage(payload, isBinary = False)
+
+
+    def written(self, tags:list, result:bool):
+        ''' Envía por el websocket el resultado de una escritura.
+
+        Se llama desde la hebra que realiza la escritura, por lo que el envío
+        se programa en el bucle del websocket.
+
+        Args:
+        tags (str[]): Nombres de las variables escritas.
+        result (bool): Resultado de la escritura.
+
+        '''
+        response={"action":"written",
+                  "tags":tags,
+                  "result":result}
+        payload = json.dumps(response).encode('utf8')
+        self.factory.loop.call_soon_threadsafe(self.sendMessage, payload, False)
 
     def transform_read(self, tags, subscribe:bool):
         ''' Conversión del valor de variables segun su tipo.
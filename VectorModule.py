@@ -0,0 +1,235 @@
+''' Evaluación vectorizada de alarmas con NumPy.
+
+Las alarmas sencillas (una variable comparada con un umbral, con operaciones
+aritméticas por constantes) se agrupan en núcleos por tipo de comparación
+y se evalúan todas a la vez, una vez por ciclo de escaneo.
+
+'''
+
+__author__="José A. Casares"
+__date__="2026-10-18"
+__version__="1.0"
+
+from TagModule import *
+from threading import Lock
+import ast
+
+try:
+    import numpy
+except ImportError:
+    numpy=None
+
+
+class VectorEngine(Subscriptor):
+    ''' Motor de evaluación vectorizada de alarmas.
+
+    Se suscribe a las variables usadas por las alarmas, guarda sus valores
+    en un vector contiguo y, al final de cada ciclo de escaneo de un controlador,
+    evalúa en los núcleos las alarmas cuyas variables han cambiado. Sólo se escriben
+    en las salidas las alarmas que cambian de estado.
+
+    Attributes:
+    alarm (Alarm[]): Alarmas evaluadas por el motor.
+    index (int{}): Posición de cada variable en el vector de valores.
+    values (ndarray): Valores de las variables (NaN si no tienen valor).
+    kernel ({}): Núcleos de evaluación por tipo de comparación.
+    dirty (int{}): Posiciones de las variables que han cambiado desde la última evaluación.
+    lock (Lock): Exclusión entre las hebras de los controladores.
+    operators ({}): Funciones de NumPy para cada comparación.
+    evaluations (int): Número de evaluaciones de alarmas realizadas (sólo cuentan
+        las alarmas evaluadas, no todas las del motor).
+
+    '''
+
+    operators={
+        ast.Gt:"greater",
+        ast.GtE:"greater_equal",
+        ast.Lt:"less",
+        ast.LtE:"less_equal",
+        ast.Eq:"equal",
+        ast.NotEq:"not_equal"}
+
+    def __init__(self):
+        if numpy is None:
+            raise Exception("NumPy is required for vectorized alarm evaluation")
+        self.alarm=[]
+        self.index={}
+        self.values=numpy.zeros(0)
+        self.kernel={}
+        self.dirty=set()
+        self.lock=Lock()
+        self.evaluations=0
+
+    def add(self, alarm:Alarm) -> bool:
+        ''' Añade una alarma al motor si su definición es vectorizable.
+
+        Args:
+        alarm (Alarm): Alarma.
+
+        Returns (bool):
+        Verdadero si la alarma se evaluará en el motor. Si es falso,
+        la alarma debe analizarse de la forma habitual.
+
+        '''
+        try:
+            source=alarm.translate()
+        except Exception:
+            raise Exception("Bad expression: "+alarm.definition)
+        if len(set(alarm.usedtags))!=1:     # Una única variable, y de controlador.
+            return False
+        tag=alarm.usedtags[0]
+        if tag.memory is None:
+            return False
+        body=ast.parse(source,mode="eval").body.body
+        if isinstance(body,ast.Compare):
+            if len(body.ops)>1 or not type(body.ops[0]) in VectorEngine.operators:
+                return False
+            left=self.linear(body.left)
+            right=self.linear(body.comparators[0])
+            if left is None or right is None:
+                return False
+            operator=type(body.ops[0])
+            scale=left[0]-right[0]
+            offset=left[1]-right[1]
+        else:
+            linear=self.linear(body)
+            if linear is None:
+                return False
+            operator=ast.NotEq
+            scale, offset=linear
+        if scale==0:
+            return False
+        if not tag in self.index:
+            self.index[tag]=len(self.index)
+        kernel=self.kernel.setdefault(operator,{"alarm":[],"position":[],"scale":[],"offset":[]})
+        kernel["alarm"].append(alarm)
+        kernel["position"].append(self.index[tag])
+        kernel["scale"].append(scale)
+        kernel["offset"].append(offset)
+        self.alarm.append(alarm)
+        return True
+
+    def linear(self, node):
+        ''' Reduce un nodo sintáctico a la forma escala*variable+desplazamiento.
+
+        Args:
+        node: Nodo del árbol sintáctico de la definición.
+
+        Returns ((float,float)):
+        Escala y desplazamiento, o None si el nodo no es lineal en una variable.
+
+        '''
+        if isinstance(node,ast.Constant):
+            return (0.0,float(node.value))
+        if isinstance(node,ast.Name):
+            return (1.0,0.0)
+        if isinstance(node,ast.UnaryOp):
+            operand=self.linear(node.operand)
+            if operand is None:
+                return None
+            if isinstance(node.op,ast.USub):
+                return (-operand[0],-operand[1])
+            return operand
+        if isinstance(node,ast.BinOp):
+            left=self.linear(node.left)
+            right=self.linear(node.right)
+            if left is None or right is None:
+                return None
+            if isinstance(node.op,ast.Add):
+                return (left[0]+right[0],left[1]+right[1])
+            if isinstance(node.op,ast.Sub):
+                return (left[0]-right[0],left[1]-right[1])
+            if isinstance(node.op,ast.Mult):
+                if left[0]==0:
+                    return (left[1]*right[0],left[1]*right[1])
+                if right[0]==0:
+                    return (right[1]*left[0],right[1]*left[1])
+            if isinstance(node.op,ast.Div) and right[0]==0 and right[1]!=0:
+                return (left[0]/right[1],left[1]/right[1])
+        return None
+
+    def build(self):
+        ''' Prepara los vectores de los núcleos y realiza las suscripciones.
+
+        Debe llamarse cuando se han añadido todas las alarmas.
+
+        '''
+        self.values=numpy.full(len(self.index),numpy.nan)
+        for operator,kernel in self.kernel.items():
+            kernel["function"]=getattr(numpy,VectorEngine.operators[operator])
+            kernel["position"]=numpy.array(kernel["position"],dtype=numpy.intp)
+            kernel["scale"]=numpy.array(kernel["scale"])
+            kernel["offset"]=numpy.array(kernel["offset"])
+            kernel["state"]=numpy.zeros(len(kernel["alarm"]),dtype=bool)
+        for tag in self.index:
+            tag.subscribe(self)
+            tag.memory.plc.subscribe_scan(self)
+            self.update(tag)
+
+    def update(self, tag:PLC.Memory.Tag):
+        ''' Copia al vector el nuevo valor de una variable.
+
+        Args:
+        tag (Tag): Variable cuyo valor ha cambiado.
+
+        '''
+        try:
+            value=float(tag.value)
+        except (TypeError, ValueError):
+            value=numpy.nan
+        position=self.index[tag]
+        with self.lock:
+            self.values[position]=value
+            self.dirty.add(position)
+
+    def endscan(self, plc:PLC):
+        ''' Evalúa los núcleos al final de un ciclo de escaneo.
+
+        Los cambios de las alarmas se avisan en una transacción del controlador,
+        de modo que cada suscriptor los recibe en un solo lote (ver PLC.commit).
+
+        Args:
+        plc (PLC): Controlador que ha terminado el ciclo.
+
+        '''
+        if len(self.dirty)>0:
+            plc.begin()
+            try:
+                self.evaluate(plc)
+            finally:
+                plc.commit()
+
+    def evaluate(self, plc:PLC=None):
+        ''' Evalúa las alarmas cuyas variables han cambiado y escribe las que cambian de estado.
+
+        Como en Expression, si la variable no tiene valor la alarma conserva su estado.
+
+        Args:
+        plc (PLC): Controlador con una transacción abierta en la que se anotan los
+            cambios de las alarmas. Si es None, se avisa a los suscriptores uno a uno.
+
+        '''
+        with self.lock:
+            dirty=numpy.fromiter(self.dirty,dtype=numpy.intp,count=len(self.dirty))
+            self.dirty=set()
+            flips=[]
+            for kernel in self.kernel.values():
+                selected=numpy.flatnonzero(numpy.isin(kernel["position"],dirty))
+                if len(selected)==0:
+                    continue
+                self.evaluations+=len(selected)
+                x=self.values[kernel["position"][selected]]
+                state=kernel["function"](x*kernel["scale"][selected]+kernel["offset"][selected],0.0)
+                changed=numpy.flatnonzero((state!=kernel["state"][selected]) & ~numpy.isnan(x))
+                if len(changed)>0:
+                    kernel["state"][selected[changed]]=state[changed]
+                    for i in changed:
+                        flips.append((kernel["alarm"][selected[i]],bool(state[i])))
+        for alarm,value in flips:
+            oldvalue=alarm.value
+            alarm.value=value
+            alarm.report(oldvalue)
+            if plc is None:
+                alarm.notify()
+            else:
+                plc.change(alarm)
@@ -9,5 +9,6 @@ setup(name='UWS',
       author_email='josecasares@gmail.com',
       url='http://josecasares.com/',
       packages=[],
-      install_requires=['sqlalchemy','pymodbus3','freeopcua','autobahn']
+      install_requires=['sqlalchemy','pymodbus3','freeopcua','autobahn'],
+      extras_require={'vectorized':['numpy']}
      )
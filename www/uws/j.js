@@ -224,6 +224,7 @@ function trend_init() {
 function trend_update(id) {
 		request["from"]=$("#"+id).attr("data-from");
 		request["to"]=$("#"+id).attr("data-to");
+		request["points"]=$("#"+id+"-trend").width();
 		
 		tags=[]
 		$("#"+id).attr("data-trend").split(";").forEach(function(str) {